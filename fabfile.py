@@ -1,8 +1,13 @@
 from fabric.api import *
 
+from gab.benchmark import *
+from gab.facts import *
 from gab.install import *
 from gab.maintenance import *
+from gab.mirror import *
 from gab.operations import *
+from gab.parallel import *
+from gab.pool import *
 from gab.server_density import *
 from gab.services import *
 from gab.setup import *
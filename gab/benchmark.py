@@ -0,0 +1,226 @@
+import itertools
+import json
+import os
+import re
+import resource
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from fabric.api import env, settings, hide, abort, puts, runs_once
+from fabric.operations import _AttributeString
+
+from gab import download, remote, setup
+from gab import install as _install
+
+
+__all__ = ['benchmark']
+
+
+#: file with the stored results, override with ``env.benchmark_file``
+RESULTS_FILE = 'benchmark.json'
+
+#: the recipes and tasks that are measured: name, function and arguments
+BENCHMARKS = [
+    ('setup_base', setup.setup_base, ()),
+    ('setup_desktop', setup.setup_desktop, ()),
+    ('setup_developer_desktop', setup.setup_developer_desktop, ()),
+    ('setup_webserver', setup.setup_webserver, ()),
+    ('setup_database', setup.setup_database, ()),
+    ('setup_apt_cacher', setup.setup_apt_cacher, ()),
+    ('setup_rabbitmq', setup.setup_rabbitmq, ('gab', 'secret', '/gab')),
+    ('install_dotfiles', _install.install_dotfiles, ()),
+    ('install_python', _install.install_python, ('dev',)),
+    ('install_nginx', _install.install_nginx, ()),
+    ('install_apache2', _install.install_apache2, ()),
+    ('install_mysql', _install.install_mysql, ()),
+    ('install_tmux', _install.install_tmux, ()),
+    ('install_memcached', _install.install_memcached, ()),
+    ('install_memcached_client', _install.install_memcached_client, ()),
+    ('install_redis', _install.install_redis, ('2.4.4',)),
+    ('install_solr', _install.install_solr, ()),
+    ('install_rabbitmq', _install.install_rabbitmq,
+     ('gab', 'secret', '/gab')),
+    ('install_uwsgi', _install.install_uwsgi, ()),
+]
+
+#: numbers for the stand-in hosts
+_hosts = itertools.count(1)
+
+
+class _StandIn(object):
+    '''
+    A recording stand-in for a fresh host: it takes the place of the remote
+    operations (and of the downloads) without running or fetching anything.
+    Commands get an empty output, except the ones gab needs to parse.
+    '''
+    #: output for the commands gab parses, as (regex, output) tuples
+    OUTPUT = [
+        (re.compile(r'gab-fact arch'), '\n'.join([
+            'gab-fact arch x86_64', 'gab-fact dpkg_arch amd64',
+            'gab-fact cores 4',
+            'gab-fact memory 4194304', 'gab-fact distro Ubuntu',
+            'gab-fact release 12.04', 'gab-fact codename precise',
+            'gab-fact init upstart', 'gab-fact editor /usr/bin/vim.basic',
+            'gab-fact python cp27'])),
+        (re.compile(r'^mktemp '), '/tmp/gab-build-benchmark'),
+        # the checksum of what get() downloads, an empty file
+        (re.compile(r'^sha256sum '), 'e3b0c44298fc1c149afbf4c8996fb92427ae41'
+                                     'e4649b934ca495991b7852b855'),
+    ]
+
+    def _result(self, command):
+        output = ''
+        for regex, value in self.OUTPUT:
+            if regex.search(command):
+                output = value
+                break
+        result = _AttributeString(output)
+        result.command = command
+        result.return_code = 0
+        result.succeeded = True
+        result.failed = False
+        return result
+
+    def run(self, command, **kwargs):
+        return self._result(command)
+
+    def sudo(self, command, **kwargs):
+        return self._result(command)
+
+    def put(self, local_path, remote_path, **kwargs):
+        return [remote_path]
+
+    def get(self, remote_path, local_path, **kwargs):
+        open(local_path, 'w').close()
+        return [local_path]
+
+    def exists(self, path, **kwargs):
+        return False
+
+    def sed(self, filename, before, after, **kwargs):
+        pass
+
+    def urlopen(self, url):
+        return StringIO(url)
+
+
+def _cpu_time():
+    'The CPU time (user and system, in seconds) this process used so far'
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _measure(func, args):
+    '''
+    Run ``func`` against a :class:`_StandIn` and measure what it sends.
+
+    :return: a dict with the number of ``commands``, the number of
+        ``round_trips`` (a :func:`gab.remote.batch` is one round trip), the
+        ``bytes`` sent and received and the ``cpu`` time (in seconds) gab
+        used
+    :rtype: dict
+    '''
+    stand_in = _StandIn()
+    saved = remote.api, remote.files, download.urllib2
+    remote.api = remote.files = download.urllib2 = stand_in
+    cache_dir = tempfile.mkdtemp(prefix='gab-benchmark-')
+    count = len(remote._timings)
+    # a new host for every benchmark, so nothing is known about it yet
+    host = 'benchmark%d' % next(_hosts)
+    start = _cpu_time()
+    try:
+        with settings(hide('everything'), host_string=host, step_workers=1,
+                      build_cache_dir=os.path.join(cache_dir, 'builds'),
+                      wheel_cache_dir=os.path.join(cache_dir, 'wheels'),
+                      stream_log_dir=os.path.join(cache_dir, 'logs'),
+                      download_cache_dir=os.path.join(cache_dir,
+                                                      'downloads')):
+            func(*args)
+    finally:
+        cpu = _cpu_time() - start
+        remote.api, remote.files, download.urllib2 = saved
+        shutil.rmtree(cache_dir)
+        timings = remote._timings[count:]
+        # these aren't real operations, keep them out of the timing report
+        del remote._timings[count:]
+    return {
+        'commands': len([t for t in timings
+                         if t['operation'] in ('run', 'sudo')]),
+        'round_trips': len([t for t in timings if t['status'] != 'batched']),
+        'bytes': sum(t['bytes'] for t in timings),
+        'cpu': round(cpu, 3),
+    }
+
+
+def _load_results():
+    'The stored results, per benchmark'
+    path = getattr(env, 'benchmark_file', RESULTS_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_results(results):
+    'Store the results, per benchmark'
+    path = getattr(env, 'benchmark_file', RESULTS_FILE)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def _change(new, old):
+    '''Format a number and its change, e.g. ``12 (+2)``'''
+    if old is None or new == old:
+        return str(new)
+    if isinstance(new, float):
+        return '%s (%+.3f)' % (new, new - old)
+    return '%s (%+d)' % (new, new - old)
+
+
+@runs_once
+def benchmark(*names):
+    '''
+    Measure the overhead of the ``setup_*`` recipes and the major
+    ``install_*`` tasks (default: all of :data:`BENCHMARKS`), e.g.::
+
+        fab benchmark
+        fab benchmark:setup_base,install_nginx
+
+    Nothing is run on a host: the remote operations go to a recording
+    stand-in for a fresh host. For every benchmark the number of remote
+    commands, round trips, bytes and the CPU time of gab are printed, with
+    the change since the stored results (``env.benchmark_file``, default
+    :data:`RESULTS_FILE`).
+
+    A benchmark that needs more round trips than before is flagged and the
+    results aren't stored (set ``env.benchmark_accept`` to store them
+    anyway), otherwise the new results are stored.
+
+    :param names: the names of the benchmarks to run
+    '''
+    benchmarks = [b for b in BENCHMARKS if not names or b[0] in names]
+    unknown = set(names) - set(b[0] for b in benchmarks)
+    if unknown:
+        abort('Unknown benchmark(s): %s' % ', '.join(sorted(unknown)))
+    stored = _load_results()
+    results = dict(stored)
+    rows = [('Benchmark', 'Commands', 'Round trips', 'Bytes', 'CPU (s)')]
+    flagged = []
+    for name, func, args in benchmarks:
+        result = _measure(func, args)
+        results[name] = result
+        old = stored.get(name, {})
+        rows.append((name,) + tuple(
+            _change(result[key], old.get(key))
+            for key in ('commands', 'round_trips', 'bytes', 'cpu')))
+        if result['round_trips'] > old.get('round_trips',
+                                           result['round_trips']):
+            flagged.append(name)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        puts('  '.join(col.ljust(widths[i]) for i, col in enumerate(row)),
+             show_prefix=False)
+    if flagged and not getattr(env, 'benchmark_accept', False):
+        abort('More round trips than before: %s' % ', '.join(flagged))
+    _save_results(results)
@@ -0,0 +1,387 @@
+import fcntl
+import hashlib
+import os
+from StringIO import StringIO
+from contextlib import contextmanager
+
+from fabric.api import env, settings, hide, prefix, cd, puts, abort
+
+from gab.facts import facts
+from gab.maintenance import install, flush_install, _apt_get
+from gab.remote import (run, sudo, put, get, batch, sync_files, stream,
+                        checksum)
+
+
+#: directory on the control machine that keeps the build artifacts, override
+#: with ``env.build_cache_dir``
+CACHE_DIR = '~/.gab/builds'
+#: directory on the ``env.deb_repo`` node with the packages, one flat
+#: repository per distro release, override with ``env.deb_repo_dir``
+REPO_DIR = '/var/www/gab'
+#: the apt source of the ``env.deb_repo`` repository on the hosts
+REPO_SOURCES = '/etc/apt/sources.list.d/gab.list'
+#: directory on the control machine that keeps the wheels, one wheelhouse per
+#: distro release, architecture and Python version, override with
+#: ``env.wheel_cache_dir``
+WHEEL_DIR = '~/.gab/wheels'
+#: the wheelhouse on the hosts
+REMOTE_WHEEL_DIR = '~/.gab/wheels'
+#: memory (in MB) a single ``make`` job may need, used to limit the number of
+#: parallel jobs on hosts with a lot of cores but little memory
+MEMORY_PER_JOB = 512
+
+def _platform():
+    '''
+    The distro release and architecture of the current host.
+
+    :return: a tuple with the release and the architecture
+    :rtype: tuple
+    '''
+    info = facts()
+    return (info['release'], info['arch'])
+
+
+def make_jobs(jobs=None):
+    '''
+    The number of parallel ``make`` jobs for the current host: one per core,
+    as long as there is :data:`MEMORY_PER_JOB` MB of memory for each of them,
+    but never more than ``env.make_max_jobs`` (if set).
+
+    :param int jobs: use this number instead of the one based on the host
+    :rtype: int
+    '''
+    if jobs is None:
+        info = facts()
+        jobs = min(info['cores'], info['memory'] / MEMORY_PER_JOB)
+    jobs = int(jobs)
+    max_jobs = getattr(env, 'make_max_jobs', None)
+    if max_jobs:
+        jobs = min(jobs, int(max_jobs))
+    return max(jobs, 1)
+
+
+def make(target='', jobs=None, use_sudo=False):
+    '''
+    Run ``make`` with as many parallel jobs as the host can handle. The
+    output is streamed, see :func:`gab.remote.stream`.
+
+    :param str target: the make target(s), e.g. ``install``
+    :param int jobs: the number of jobs, default :func:`make_jobs`
+    :param bool use_sudo: run ``make`` as root
+    '''
+    cmd = ('make -j%d %s' % (make_jobs(jobs), target)).strip()
+    return stream(cmd, use_sudo=use_sudo)
+
+
+@contextmanager
+def _compiler_env():
+    '''
+    The context for compiling: when ``env.ccache`` is set, the compilers are
+    replaced by ccache. Its cache is kept in ``env.ccache_dir`` (default
+    ``~/.ccache``), so rebuilding the same sources on a host is fast.
+    '''
+    if not getattr(env, 'ccache', False):
+        yield
+        return
+    install('ccache')
+    flush_install()
+    cmd = 'export PATH=/usr/lib/ccache:$PATH'
+    if getattr(env, 'ccache_dir', None):
+        cmd += ' CCACHE_DIR=%s' % env.ccache_dir
+    with prefix(cmd):
+        yield
+
+
+def _makedirs(path):
+    '''Create a local directory (and its parents) if it doesn't exist yet'''
+    try:
+        os.makedirs(path)
+    except OSError:
+        # it exists, maybe another host created it just now
+        if not os.path.isdir(path):
+            raise
+
+
+def _artifact(name, version, flags, extension='tar.gz'):
+    '''
+    The local file for a build of ``name`` on the current host
+
+    :param str name: the name of the software
+    :param str version: the version of the software
+    :param str flags: the flags (e.g. for ``configure``) of the build
+    :param str extension: ``tar.gz`` or ``deb``
+    '''
+    release, arch = _platform()
+    digest = hashlib.sha1(flags).hexdigest()[:8]
+    cache_dir = os.path.expanduser(getattr(env, 'build_cache_dir', CACHE_DIR))
+    return os.path.join(cache_dir, '%s-%s-%s-%s-%s.%s' % (
+        name, version, release, arch, digest, extension))
+
+
+def _stage(build):
+    '''
+    Call ``build`` with a new staging directory on the current host
+
+    :return: the staging directory
+    :rtype: str
+    '''
+    with hide('running', 'stdout'):
+        stage = run('mktemp -d /tmp/gab-build-XXXXXX')
+    with _compiler_env():
+        build(stage)
+    return stage
+
+
+def _keep(remote_file, local_file):
+    '''
+    Download a build artifact into the cache on the control machine
+
+    :param str remote_file: the artifact on the current host
+    :param str local_file: the file in the cache
+    '''
+    _makedirs(os.path.dirname(local_file))
+    # don't leave half a file in the cache when the transfer fails (or when
+    # other hosts build the same thing in parallel)
+    part = '%s.%s.part' % (local_file, os.getpid())
+    get(remote_file, part)
+    digest = hashlib.sha256()
+    with open(part, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            digest.update(chunk)
+    if digest.hexdigest() != checksum(remote_file):
+        os.remove(part)
+        abort('The download of %s is not the same as the file on %s' % (
+            remote_file, env.host_string))
+    os.rename(part, local_file)
+
+
+@contextmanager
+def _locked(local_file):
+    '''
+    Hold the lock of a build artifact on the control machine, so only one
+    host (of the ones that run in parallel) builds it and the others wait
+    for it and use it
+    '''
+    _makedirs(os.path.dirname(local_file))
+    with open(local_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def cached_build(name, version, build, flags='', root='/', replaces=''):
+    '''
+    Build software only once for every distro release and architecture.
+
+    The first time, ``build`` is called with a (remote) staging directory
+    (with ccache enabled if ``env.ccache`` is set, see :func:`_compiler_env`).
+    It has to compile the software and install it into that directory as if
+    it were ``root``, e.g. with ``make install DESTDIR=<stage>``. The staging
+    directory is packed and kept in ``env.build_cache_dir`` (default
+    :data:`CACHE_DIR`) on the control machine. Every host with the same
+    name, version, flags, release and architecture gets that tarball
+    unpacked in ``root``, without building anything.
+
+    With ``env.deb_repo`` set (see :func:`package_build`), software for
+    ``/`` is packaged as ``gab-<name>`` and installed with apt instead.
+
+    :param str name: the name of the software
+    :param str version: the version of the software
+    :param build: function that builds the software into the staging
+        directory it receives
+    :param str flags: the flags that change the build (e.g. the arguments
+        for ``configure``)
+    :param str root: where to unpack the files, ``/`` (as root) or ``~``
+    :param str replaces: the packages whose files the package may overwrite
+        (a ``Replaces`` field), only for ``env.deb_repo``
+    :return: whether the software was built on this host
+    :rtype: bool
+    '''
+    if getattr(env, 'deb_repo', None) and root == '/':
+        return package_build(name, version, build, flags, replaces)
+    local_file = _artifact(name, version, flags)
+    remote_file = '/tmp/%s' % os.path.basename(local_file)
+    with _locked(local_file):
+        built = not os.path.exists(local_file)
+        if built:
+            stage = _stage(build)
+            # mktemp made the stage private, its mode is the one of ./ in
+            # the archive
+            run('chmod 755 %s && tar czf %s --owner=root --group=root '
+                '-C %s .' % (stage, remote_file, stage))
+            _keep(remote_file, local_file)
+            sudo('rm -rf %s' % stage)
+    if not built:
+        puts('Using the cached build %s' % local_file)
+        put(local_file, remote_file)
+    # the directories that exist (e.g. / or ~) keep their mode and owner
+    if root.startswith('~'):
+        run('tar xzf %s --no-overwrite-dir -C %s' % (remote_file, root))
+    else:
+        sudo('tar xzf %s --no-overwrite-dir -C %s' % (remote_file, root))
+    run('rm -f %s' % remote_file)
+    return built
+
+
+def _repo_url():
+    '''The url of the ``env.deb_repo`` repository for the hosts'''
+    url = getattr(env, 'deb_repo_url', None)
+    if not url:
+        url = 'http://%s/gab' % env.deb_repo.split('@')[-1].split(':')[0]
+    return url.rstrip('/')
+
+
+def _publish(local_file):
+    '''
+    Add a package to the repository on the ``env.deb_repo`` node, in the
+    directory of the distro release of the current host.
+
+    :param str local_file: the package on the control machine
+    '''
+    repo_dir = '%s/%s' % (getattr(env, 'deb_repo_dir', REPO_DIR),
+                          facts()['release'])
+    with settings(host_string=env.deb_repo):
+        sudo('mkdir -p %s' % repo_dir)
+        put(local_file, repo_dir, use_sudo=True)
+        # the index is replaced at once (apt never reads half of it), the
+        # lock keeps hosts in parallel from publishing at the same time
+        with cd(repo_dir):
+            sudo('(flock 9 && dpkg-scanpackages -m . /dev/null | '
+                 'gzip -9c > Packages.gz.new && mv Packages.gz.new Packages.gz'
+                 ') 9>.lock')
+
+
+def package_build(name, version, build, flags='', replaces=''):
+    '''
+    Like :func:`cached_build`, but the software is built only once into a
+    package (``gab-<name>``). The package is published in a flat apt
+    repository on the ``env.deb_repo`` node (in ``env.deb_repo_dir``, default
+    :data:`REPO_DIR`, one directory per distro release) and installed with
+    apt. Every other host gets the source for that repository (served at
+    ``env.deb_repo_url``, default ``http://<env.deb_repo>/gab``) and installs
+    the package, dpkg keeps track of its files.
+
+    The node only needs ``dpkg-dev`` and a web server for the directory, see
+    :func:`gab.setup.setup_deb_repo`.
+
+    :return: whether the software was built on this host
+    :rtype: bool
+    '''
+    package = 'gab-%s' % name
+    package_version = '%s-gab%s' % (version,
+                                    hashlib.sha1(flags).hexdigest()[:8])
+    info = facts()
+    if info['packages'].get(package) == package_version:
+        return False
+    local_file = _artifact(name, version, flags, 'deb')
+    with _locked(local_file):
+        built = not os.path.exists(local_file)
+        if built:
+            install('fakeroot')
+            flush_install()
+            stage = _stage(build)
+            control = [
+                'Package: %s' % package,
+                'Version: %s' % package_version,
+                'Architecture: %s' % info['dpkg_arch'],
+                'Maintainer: gab <root@localhost>',
+                'Description: %s %s, built by gab' % (name, version),
+            ]
+            if replaces:
+                control.append('Replaces: %s' % replaces)
+            run('mkdir -p %s/DEBIAN' % stage)
+            put(StringIO('\n'.join(control) + '\n'),
+                '%s/DEBIAN/control' % stage)
+            remote_file = '/tmp/%s' % os.path.basename(local_file)
+            # mktemp made the stage private, it becomes / on the hosts
+            run('chmod 755 %s && fakeroot dpkg-deb --build %s %s' % (
+                stage, stage, remote_file))
+            _keep(remote_file, local_file)
+            with batch():
+                sudo('rm -rf %s' % stage)
+                run('rm -f %s' % remote_file)
+            _publish(local_file)
+    source = 'deb [trusted=yes] %s/%s ./' % (_repo_url(), info['release'])
+    # only refresh the lists of this repository
+    with batch():
+        sudo("grep -qxF '%(source)s' %(file)s 2>/dev/null || "
+             "echo '%(source)s' > %(file)s" % {'source': source,
+                                                'file': REPO_SOURCES})
+        _apt_get('update -q -o Dir::Etc::sourcelist=%s '
+                 '-o Dir::Etc::sourceparts=- -o APT::Get::List-Cleanup=0'
+                 % REPO_SOURCES)
+    install('%s=%s' % (package, package_version))
+    flush_install()
+    return built
+
+
+def _wheelhouse():
+    '''
+    The local wheelhouse for the current host, it's created if it doesn't
+    exist yet
+    '''
+    release, arch = _platform()
+    cache_dir = os.path.expanduser(getattr(env, 'wheel_cache_dir', WHEEL_DIR))
+    # facts kept on disk by an older gab don't have the Python version
+    python = facts().get('python') or 'python'
+    path = os.path.join(cache_dir, '%s-%s-%s' % (release, arch, python))
+    _makedirs(path)
+    return path
+
+
+def pip_install(packages, pip='pip', find_links=(), use_sudo=False):
+    '''
+    Install Python packages from wheels, so the C extensions (e.g.
+    MySQL-python, PIL, pylibmc) are compiled only once for every distro
+    release, architecture and Python version.
+
+    The wheels are kept in ``env.wheel_cache_dir`` (default
+    :data:`WHEEL_DIR`) on the control machine. The ones the host doesn't have
+    yet are sent to :data:`REMOTE_WHEEL_DIR` (see
+    :func:`gab.remote.sync_files`). There ``pip wheel`` only builds the
+    missing wheels and all packages are installed with one ``pip install``
+    that doesn't use the package index. New wheels are brought back to the
+    control machine for the next hosts.
+
+    :param list packages: the requirements, e.g. ``['Django==1.3']`` or
+        ``['-r', 'requirements.txt']``
+    :param str pip: the pip of the environment, e.g. ``~/env/x/bin/pip``
+    :param list find_links: extra urls for ``pip --find-links``
+    :param bool use_sudo: install as root
+    '''
+    local_dir = _wheelhouse()
+    wheels = sorted(name for name in os.listdir(local_dir)
+                    if name.endswith('.whl'))
+    sync_files([(os.path.join(local_dir, name),
+                 '%s/%s' % (REMOTE_WHEEL_DIR, name)) for name in wheels])
+    v = {'pip': pip, 'dir': REMOTE_WHEEL_DIR,
+         'links': ''.join(' -f %s' % link for link in find_links),
+         'packages': ' '.join(packages)}
+    # pip wheel needs the wheel package next to pip
+    wheel = '%(pip)s install -q -f %(dir)s wheel' % v
+    cmd = 'mkdir -p %(dir)s' % v
+    if use_sudo:
+        sudo(wheel)
+    else:
+        cmd += ' && ' + wheel
+    cmd += (' && %(pip)s wheel -q -w %(dir)s -f %(dir)s%(links)s %(packages)s'
+            % v)
+    install_cmd = '%(pip)s install --no-index -f %(dir)s %(packages)s' % v
+    if not use_sudo:
+        cmd += ' && ' + install_cmd
+    # the wheels, to bring the new ones back, and where they are, for sudo
+    cmd += (' && cd %(dir)s && ls | sed "s/^/gab-wheel /" && '
+            'echo gab-wheelhouse $(pwd)' % v)
+    with hide('stdout'):
+        output = run(cmd)
+    if use_sudo:
+        path = output.split('gab-wheelhouse', 1)[-1].strip()
+        sudo(install_cmd.replace(REMOTE_WHEEL_DIR, path))
+    for line in output.splitlines():
+        name = line[len('gab-wheel '):] if line.startswith('gab-wheel ') \
+            else ''
+        if name.endswith('.whl') and name not in wheels:
+            _keep('%s/%s' % (REMOTE_WHEEL_DIR, name),
+                  os.path.join(local_dir, name))
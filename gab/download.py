@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import time
+import urllib2
+from urlparse import urlparse
+
+from fabric.api import env, settings, hide, abort, puts
+
+from gab.build import _makedirs, _locked
+from gab.remote import run, sudo, put
+
+
+#: directory on the control machine that keeps the downloads, override with
+#: ``env.download_cache_dir``
+CACHE_DIR = '~/.gab/downloads'
+#: maximum size of the cache in MB, override with
+#: ``env.download_cache_max_size``
+MAX_SIZE = 1024
+#: downloads that weren't used for this many days are removed, override with
+#: ``env.download_cache_max_age``
+MAX_AGE = 30
+
+
+def _cache_dir():
+    'The local download cache directory'
+    path = os.path.expanduser(getattr(env, 'download_cache_dir', CACHE_DIR))
+    _makedirs(path)
+    return path
+
+
+def _load_index():
+    '''
+    Load the index of the cache, it maps every url to the SHA-256 checksum of
+    its content (the content is stored in a file named after the checksum).
+    '''
+    path = os.path.join(_cache_dir(), 'index.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_index(index):
+    'Save the index of the cache'
+    path = os.path.join(_cache_dir(), 'index.json')
+    tmp = '%s.%s' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _sha256(path):
+    'The SHA-256 checksum of a local file'
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fetch(url, checksum=None):
+    '''
+    Get ``url`` from the cache, download it first if it's not there (or if
+    the cached copy is damaged).
+
+    :param str url: the url
+    :param str checksum: the expected SHA-256 checksum. If not given, the
+        checksum of the first download is used to verify the later ones.
+    :return: the checksum and the local path
+    :rtype: tuple
+    '''
+    cache_dir = _cache_dir()
+    # hosts in parallel (see gab.parallel) share the index, it's read,
+    # changed and written by one of them at a time
+    with _locked(os.path.join(cache_dir, 'index.json')):
+        index = _load_index()
+        digest = checksum or index.get(url)
+        if digest:
+            path = os.path.join(cache_dir, digest)
+            if os.path.exists(path) and _sha256(path) == digest:
+                # remember when it was used last, for the eviction
+                os.utime(path, None)
+                return digest, path
+
+        puts('Downloading %s' % url)
+        tmp = os.path.join(cache_dir, 'download.%s' % os.getpid())
+        response = urllib2.urlopen(url)
+        try:
+            with open(tmp, 'wb') as f:
+                for block in iter(lambda: response.read(1 << 16), ''):
+                    f.write(block)
+        finally:
+            response.close()
+        found = _sha256(tmp)
+        if digest and found != digest:
+            os.remove(tmp)
+            abort('Checksum mismatch for %s: expected %s, got %s' % (
+                url, digest, found))
+        path = os.path.join(cache_dir, found)
+        os.rename(tmp, path)
+        index[url] = found
+        _save_index(index)
+        _evict(keep=path)
+        return found, path
+
+
+def _evict(keep=None):
+    '''
+    Remove the downloads that weren't used for ``env.download_cache_max_age``
+    days, then the least recently used ones until the cache is smaller than
+    ``env.download_cache_max_size`` MB. The caller holds the lock of the
+    index.
+
+    :param str keep: a file that has to stay (the one we're about to use)
+    '''
+    cache_dir = _cache_dir()
+    max_age = float(getattr(env, 'download_cache_max_age', MAX_AGE)) * 86400
+    max_size = float(getattr(env, 'download_cache_max_size', MAX_SIZE)) * 2**20
+    index = _load_index()
+    files = []
+    for digest in set(index.values()):
+        path = os.path.join(cache_dir, digest)
+        if os.path.exists(path) and path != keep:
+            stat = os.stat(path)
+            files.append((stat.st_mtime, stat.st_size, digest, path))
+    files.sort()
+    total = sum(f[1] for f in files)
+    if keep and os.path.exists(keep):
+        total += os.path.getsize(keep)
+    removed = set()
+    for mtime, size, digest, path in files:
+        if time.time() - mtime < max_age and total <= max_size:
+            break
+        os.remove(path)
+        total -= size
+        removed.add(digest)
+    if removed:
+        _save_index(dict((url, digest) for url, digest in index.items()
+                         if digest not in removed))
+
+
+def download(url, remote_path=None, checksum=None, use_sudo=False):
+    '''
+    Put the content of ``url`` on the current host. The url is fetched only
+    once into the cache on the control machine (``env.download_cache_dir``,
+    default :data:`CACHE_DIR`) and uploaded from there.
+
+    When ``env.download_mirror`` is set (e.g. ``http://cache.lan/gab/``, a web
+    server that serves a copy of the cache directory), the host fetches the
+    file from that mirror and only falls back to an upload if that fails.
+
+    :param str url: the url
+    :param str remote_path: where to put the file, default the file name from
+        the url (relative to the current directory)
+    :param str checksum: the expected SHA-256 checksum
+    :param bool use_sudo: write the file as root
+    '''
+    if remote_path is None:
+        remote_path = os.path.basename(urlparse(url).path)
+    digest, path = _fetch(url, checksum)
+    mirror = getattr(env, 'download_mirror', None)
+    if mirror:
+        cmd = 'wget -q %s/%s -O %s && echo "%s  %s" | sha256sum -c --quiet -' % (
+            mirror.rstrip('/'), digest, remote_path, digest, remote_path)
+        with settings(hide('warnings'), warn_only=True):
+            if (sudo(cmd) if use_sudo else run(cmd)).succeeded:
+                return
+    put(path, remote_path, use_sudo=use_sudo)
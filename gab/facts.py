@@ -0,0 +1,156 @@
+import json
+import os
+import time
+
+from fabric.api import env, hide, puts
+
+from gab.remote import run
+
+
+__all__ = ['show_facts']
+
+
+#: directory on the control machine for the facts of every host, override
+#: with ``env.facts_cache_dir``
+CACHE_DIR = '~/.gab/facts'
+#: default number of seconds the facts on disk can be used, override with
+#: ``env.facts_ttl`` (``0`` only keeps them for the current run)
+TTL = 0
+
+#: the script that prints all facts, see :func:`_parse`
+_SCRIPT = '\n'.join([
+    'echo gab-fact arch $(uname -m)',
+    'echo gab-fact dpkg_arch $(dpkg --print-architecture)',
+    'echo gab-fact cores $(getconf _NPROCESSORS_ONLN)',
+    "echo gab-fact memory $(awk '/^MemTotal:/ {print $2}' /proc/meminfo)",
+    'echo gab-fact distro $(lsb_release -is)',
+    'echo gab-fact release $(lsb_release -rs)',
+    'echo gab-fact codename $(lsb_release -cs)',
+    'if [ -d /run/systemd/system ]; then init=systemd; '
+    'elif /sbin/initctl version 2>/dev/null | grep -q upstart; then '
+    'init=upstart; else init=sysvinit; fi; echo gab-fact init $init',
+    'echo gab-fact editor $(readlink -f /etc/alternatives/editor)',
+    'echo gab-fact python $(python -c '
+    '"import sys; print(\'cp%d%d\' % sys.version_info[:2])")',
+    "dpkg-query -W -f='gab-package ${Status} ${Package} ${Version}\\n'",
+    "/sbin/initctl list 2>/dev/null | "
+    "awk '/start\\/running/ {print \"gab-service\", $1}'",
+    "service --status-all 2>/dev/null | "
+    "awk '$2 == \"+\" {print \"gab-service\", $4}'",
+    "systemctl list-units --type=service --state=running --no-legend "
+    "2>/dev/null | awk '{sub(/\\.service$/, \"\", $1); "
+    "print \"gab-service\", $1}'",
+])
+
+#: the facts per host, see :func:`facts`
+_facts = {}
+#: the hosts whose facts were read from ``env.facts_cache_dir`` (not
+#: gathered in this run)
+_from_disk = set()
+
+
+def _cache_file(host):
+    '''
+    The file on the control machine with the facts of ``host``
+
+    :param str host: the host string
+    '''
+    cache_dir = os.path.expanduser(getattr(env, 'facts_cache_dir',
+                                           CACHE_DIR))
+    name = host.replace(os.sep, '_').replace(':', '_')
+    return os.path.join(cache_dir, '%s.json' % name)
+
+
+def _parse(output):
+    '''
+    Turn the output of :data:`_SCRIPT` into the facts
+
+    :rtype: dict
+    '''
+    result = {'arch': '', 'dpkg_arch': '', 'cores': 1, 'memory': 0, 'distro': '',
+              'release': '', 'codename': '', 'init': '', 'editor': '',
+              'python': '',
+              'packages': {}, 'services': []}
+    for line in output.splitlines():
+        parts = line.split()
+        if parts[:1] == ['gab-fact'] and len(parts) > 1:
+            result[parts[1]] = ' '.join(parts[2:])
+        elif parts[:1] == ['gab-package']:
+            # gab-package install ok installed <name> <version>
+            if len(parts) == 6 and parts[3] == 'installed':
+                result['packages'][parts[4]] = parts[5]
+        elif parts[:1] == ['gab-service'] and len(parts) == 2:
+            if parts[1] not in result['services']:
+                result['services'].append(parts[1])
+    result['cores'] = int(result['cores'] or 1)
+    result['memory'] = int(result['memory'] or 0) / 1024
+    result['editor'] = os.path.basename(result['editor'])
+    result['services'].sort()
+    return result
+
+
+def facts(refresh=False):
+    '''
+    The facts of the current host, gathered with one command the first time
+    they're needed in a run. With ``env.facts_ttl`` (default :data:`TTL`)
+    set, they're also kept in ``env.facts_cache_dir`` (default
+    :data:`CACHE_DIR`) and used by the next runs for that many seconds.
+
+    :param bool refresh: gather the facts again
+    :return: a dict with ``arch`` (e.g. ``x86_64``), ``dpkg_arch`` (e.g.
+        ``amd64``), ``cores``, ``memory`` (in MB), ``distro`` (e.g.
+        ``Ubuntu``), ``release`` (e.g. ``12.04``), ``codename`` (e.g.
+        ``precise``), ``init`` (``upstart``, ``systemd`` or ``sysvinit``),
+        ``editor`` (the default editor, e.g. ``vim.basic``), ``python`` (the
+        version of the default Python, e.g. ``cp27``), ``packages`` (a
+        dict with the installed packages and their version) and
+        ``services`` (a list of the running services)
+    :rtype: dict
+    '''
+    host = env.host_string
+    if refresh:
+        forget()
+    if host in _facts:
+        return _facts[host]
+    ttl = float(getattr(env, 'facts_ttl', TTL))
+    path = _cache_file(host)
+    if ttl > 0 and os.path.exists(path) and \
+            time.time() - os.path.getmtime(path) < ttl:
+        with open(path) as f:
+            _facts[host] = json.load(f)
+        _from_disk.add(host)
+        return _facts[host]
+    with hide('running', 'stdout'):
+        _facts[host] = _parse(run(_SCRIPT))
+    _from_disk.discard(host)
+    if ttl > 0:
+        from gab.build import _makedirs
+        _makedirs(os.path.dirname(path))
+        tmp = '%s.%s' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(_facts[host], f)
+        os.rename(tmp, path)
+    return _facts[host]
+
+
+def forget():
+    '''
+    Forget the facts of the current host (e.g. after an upgrade), the next
+    call of :func:`facts` gathers them again.
+    '''
+    _facts.pop(env.host_string, None)
+    path = _cache_file(env.host_string)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def show_facts():
+    '''Print the facts of the current host'''
+    info = facts()
+    for key in sorted(info):
+        if key == 'packages':
+            puts('%s: %d installed' % (key, len(info[key])))
+        elif key == 'services':
+            puts('%s: %s' % (key, ', '.join(info[key])))
+        else:
+            puts('%s: %s' % (key, info[key]))
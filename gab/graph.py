@@ -0,0 +1,354 @@
+import Queue
+import hashlib
+import inspect
+import multiprocessing
+import time
+from functools import partial
+
+from fabric.api import env, settings, hide, abort, puts
+from fabric import state
+
+import gab
+from gab import maintenance, pool, remote, services
+from gab.facts import forget as _forget_facts
+from gab.parallel import _duration
+from gab.remote import run, _quote
+
+
+#: default number of steps that run at the same time on one host, override
+#: with ``env.step_workers``
+WORKERS = 1
+#: the journal on the host with the inputs of the steps that ran, see
+#: :func:`run_steps`
+JOURNAL = '~/.gab/steps'
+
+#: seconds between two checks whether the step processes are still alive
+_POLL_INTERVAL = 1
+
+#: the steps that already ran in this run, per host
+_done = {}
+#: how long every step took (in seconds), per host
+_durations = {}
+
+
+def _order(steps):
+    '''
+    Sort the steps so every step comes after the steps it requires.
+
+    :param dict steps: see :func:`run_steps`
+    :return: the names of the steps
+    :rtype: list
+    '''
+    order = []
+    visiting = set()
+
+    def visit(name, path):
+        if name in order:
+            return
+        if name in visiting:
+            abort('Steps depend on each other: %s' % ' -> '.join(path))
+        if name not in steps:
+            abort('Unknown step %r (required by %s)' % (name, path[-2]))
+        visiting.add(name)
+        for required in steps[name][1]:
+            visit(required, path + [required])
+        visiting.discard(name)
+        order.append(name)
+
+    for name in sorted(steps):
+        visit(name, [name])
+    return order
+
+
+def run_steps(steps):
+    '''
+    Run a recipe, described as steps that depend on each other, on the
+    current host. Every step runs at most once per host, steps that already
+    ran (e.g. in a previous recipe of this run) are skipped.
+
+    With ``env.step_workers`` (default :data:`WORKERS`) larger than 1, steps
+    that don't depend on each other run at the same time, each in its own
+    process with its own connection. ``apt-get`` still runs one at a time.
+
+    Steps can list the files they create (their outputs). These steps are
+    recorded in a journal on the host (:data:`JOURNAL`) with a hash of their
+    inputs: the name, the function (and its code), the arguments and the
+    gab version. In later runs they're skipped as long as the inputs are the
+    same and the outputs still exist, unless ``env.rerun_steps`` is set.
+    The journal is written after the packages the steps queued (in a
+    :func:`gab.maintenance.deferred_install` block) are installed.
+
+    When done, the critical path (the chain of steps that determines the
+    total time) is printed.
+
+    Example::
+
+        run_steps({
+            'update': (update, []),
+            'install_vcs': (install_vcs, ['update']),
+            'install_dotfiles': (install_dotfiles, ['install_vcs'],
+                                 ['~/.git']),
+        })
+
+    :param dict steps: the name of each step as key, a tuple with the
+        function to call, the names of the steps it requires and optionally
+        the files it creates as value
+    '''
+    host = env.host_string
+    done = _done.setdefault(host, set())
+    durations = _durations.setdefault(host, {})
+    pending = [name for name in _order(steps) if name not in done]
+    journal = _read_journal(steps, pending)
+    converged = [name for name in pending
+                 if journal.get(name) == _digest(name, steps[name][0])
+                 and not getattr(env, 'rerun_steps', False)]
+    if converged:
+        puts('Unchanged since the last run: %s' % ', '.join(converged))
+        for name in converged:
+            pending.remove(name)
+            durations[name] = 0
+            done.add(name)
+    workers = int(getattr(env, 'step_workers', WORKERS))
+    # _run_concurrent empties pending
+    to_run = list(pending)
+
+    def journal_done():
+        _write_journal(journal, dict(
+            (name, _digest(name, steps[name][0])) for name in to_run
+            if name in done and len(steps[name]) > 2))
+    try:
+        if workers > 1:
+            _run_concurrent(steps, pending, workers)
+        else:
+            for name in pending:
+                start = time.time()
+                steps[name][0]()
+                durations[name] = time.time() - start
+                done.add(name)
+    except:
+        # the packages the steps queued (in a deferred_install() block) are
+        # dropped, the steps only converged if they queued none
+        if not maintenance._package_queue.get(host):
+            journal_done()
+        raise
+    # a step only converged once its packages are installed
+    maintenance.flush_install()
+    journal_done()
+    _print_critical_path(steps)
+
+
+def _code(code):
+    '''
+    The parts of a code object that say what it does: the bytecode and the
+    constants, with the nested functions (whose repr has an address) in the
+    same form
+    '''
+    return (code.co_code, [_code(c) if inspect.iscode(c) else c
+                           for c in code.co_consts])
+
+
+def _digest(name, func):
+    '''
+    A hash of the inputs of a step: the name, the function (its code and
+    default arguments), the arguments (of a :func:`functools.partial`) and
+    the gab version.
+
+    :param str name: the name of the step
+    :param func: the function of the step
+    :rtype: str
+    '''
+    args = ()
+    kwargs = {}
+    while isinstance(func, partial):
+        args = func.args + args
+        kwargs = dict(func.keywords or {}, **kwargs)
+        func = func.func
+    code = getattr(func, 'func_code', None)
+    if code is not None:
+        code = _code(code)
+    return hashlib.sha1(repr((name, func.__module__, func.__name__, args,
+                              sorted(kwargs.items()), code,
+                              getattr(func, 'func_defaults', None),
+                              gab.__version__))).hexdigest()
+
+
+def _read_journal(steps, pending):
+    '''
+    Read the journal of the current host and check the outputs of the
+    pending steps, in one command.
+
+    :param dict steps: see :func:`run_steps`
+    :param list pending: the names of the steps that still have to run
+    :return: the hash of the inputs per step, without the pending steps of
+        which an output is missing
+    :rtype: dict
+    '''
+    journaled = [name for name in pending if len(steps[name]) > 2]
+    if not journaled:
+        return {}
+    cmd = ['cat %s 2>/dev/null' % JOURNAL]
+    for name in journaled:
+        for path in steps[name][2]:
+            cmd.append('[ -e %s ] || echo gab-missing %s' % (path, name))
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run('; '.join(cmd))
+    journal = {}
+    missing = set()
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        if parts[0] == 'gab-missing':
+            missing.add(parts[1])
+        else:
+            journal[parts[0]] = parts[1]
+    for name in missing:
+        journal.pop(name, None)
+    return journal
+
+
+def _write_journal(journal, changes):
+    '''
+    Update the journal of the current host (if anything changed).
+
+    :param dict journal: the journal, see :func:`_read_journal`
+    :param dict changes: the new hashes of the steps that ran
+    '''
+    if all(journal.get(name) == digest for name, digest in changes.items()):
+        return
+    journal.update(changes)
+    lines = ['%s %s' % entry for entry in sorted(journal.items())]
+    with hide('running'):
+        run("mkdir -p $(dirname %s) && printf '%%s\\n' %s > %s" % (
+            JOURNAL, ' '.join(_quote(line) for line in lines), JOURNAL))
+
+
+def _run_step(name, func, queue):
+    '''
+    Run a step in a child process and report the outcome on ``queue``.
+
+    :param str name: the name of the step
+    :param func: the function of the step
+    :param queue: a :class:`multiprocessing.Queue` for the name, duration,
+        error (``None`` if it succeeded), the timings of the remote
+        operations, the services to restart and the SSH statistics (see
+        :mod:`gab.pool`)
+    '''
+    # don't share the connections of the parent process
+    state.connections.clear()
+    inherited = len(remote._timings)
+    inherited_ssh = dict(pool._stats)
+    start = time.time()
+    error = None
+    try:
+        func()
+        # the parent never sees what this process queued
+        maintenance.flush_install()
+    except SystemExit:
+        # abort() already printed why
+        error = 'aborted'
+    except BaseException, e:
+        error = str(e) or e.__class__.__name__
+    # the parent restarts the services, once for all steps
+    restarts = services._restart_queue.pop(env.host_string, [])
+    queue.put((name, time.time() - start, error, remote._timings[inherited:],
+               restarts, pool._since(inherited_ssh)))
+
+
+def _next_outcome(queue, running):
+    '''
+    Wait for the outcome of a step on ``queue`` (see :func:`_run_step`). A
+    step process that died without one (killed, out of memory, an outcome
+    that can't be pickled) is a failed step.
+
+    :param dict running: the processes of the running steps, by name
+    :rtype: tuple
+    '''
+    while True:
+        try:
+            return queue.get(timeout=_POLL_INTERVAL)
+        except Queue.Empty:
+            pass
+        for name, process in running.items():
+            if not process.is_alive():
+                # its outcome may still be on the way
+                try:
+                    return queue.get(timeout=_POLL_INTERVAL)
+                except Queue.Empty:
+                    return (name, 0, 'died with exit code %s' %
+                            process.exitcode, [], [], {})
+
+
+def _run_concurrent(steps, pending, workers):
+    '''
+    Run the ``pending`` steps with at most ``workers`` at the same time.
+
+    :param dict steps: see :func:`run_steps`
+    :param list pending: the names of the steps to run, in order
+    :param int workers: the number of steps that can run at once
+    '''
+    host = env.host_string
+    done = _done[host]
+    durations = _durations[host]
+    # the children start with an empty queue and share one apt lock
+    maintenance.flush_install()
+    maintenance._apt_locks.setdefault(host, multiprocessing.Lock())
+    queue = multiprocessing.Queue()
+    running = {}
+    failed = []
+    while (pending and not failed) or running:
+        ready = []
+        if not failed:
+            ready = [name for name in pending
+                     if all(required in done for required in steps[name][1])]
+        for name in ready[:workers - len(running)]:
+            pending.remove(name)
+            process = multiprocessing.Process(target=_run_step,
+                                              args=(name, steps[name][0],
+                                                    queue))
+            process.start()
+            running[name] = process
+        name, duration, error, timings, restarts, ssh = _next_outcome(
+            queue, running)
+        running.pop(name).join()
+        remote._timings.extend(timings)
+        pool._merge(ssh)
+        for service, action in restarts:
+            getattr(services, action)(service)
+        durations[name] = duration
+        if error:
+            failed.append('%s (%s)' % (name, error))
+        else:
+            done.add(name)
+    # the children installed packages and wrote files we don't know about
+    _forget_facts()
+    remote._probes.pop(host, None)
+    if failed:
+        abort('Failed steps: %s' % ', '.join(failed))
+
+
+def _print_critical_path(steps):
+    '''
+    Print the chain of steps that took the longest on the current host.
+
+    :param dict steps: see :func:`run_steps`
+    '''
+    durations = _durations.get(env.host_string, {})
+    finish = {}
+    previous = {}
+    for name in _order(steps):
+        start = 0
+        for required in steps[name][1]:
+            if finish[required] > start:
+                start = finish[required]
+                previous[name] = required
+        finish[name] = start + durations.get(name, 0)
+    if not finish:
+        return
+    name = max(finish, key=finish.get)
+    total = finish[name]
+    path = []
+    while name:
+        path.insert(0, '%s (%s)' % (name, _duration(durations.get(name, 0))))
+        name = previous.get(name)
+    puts('Critical path (%s): %s' % (_duration(total), ' -> '.join(path)))
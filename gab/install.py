@@ -1,25 +1,63 @@
+import os
+
 from fabric.api import *
-from fabric.contrib.files import exists, append, sed
 
-from gab.maintenance import apt_update, install
-from gab.services import restart, start, stop
+from gab.build import (cached_build as _cached_build, make as _make,
+                       pip_install as _pip_install)
+from gab.download import download as _download
+from gab.facts import facts as _facts
+from gab.maintenance import apt_update, install, flush_install
+from gab.mirror import mirrors as _mirrors
+from gab.remote import run, sudo, exists, append, sed, batch, stream
+from gab.services import restart, reload, start, stop
 from gab.validators import validate_not_empty as _validate_not_empty
 
 
+__all__ = ['install_dotfiles', 'install_default_packages', 'install_vcs',
+           'install_python', 'create_python_env', 'install_ruby',
+           'install_duplicity', 'install_nginx', 'install_apache2',
+           'install_mysql', 'install_mysql_server', 'install_mysql_client',
+           'install_apt_cacher', 'install_tmux', 'install_latex',
+           'install_vlc', 'install_cdripper', 'install_dvdripper',
+           'install_wine', 'install_moc', 'install_systools',
+           'install_memcached', 'install_memcached_client',
+           'install_memcached_client_python', 'install_redis', 'install_solr',
+           'install_rabbitmq', 'install_rabbitmq_plugins', 'install_uwsgi',
+           'install_kvm']
+
+
 def install_dotfiles(repo='http://github.com/gvangool/dotfiles.git'):
     '''
     Install the dotfiles from the given repository.
 
+    With ``env.git_mirror`` set, the repository and its submodules are
+    cloned from their mirrors on that node (see :mod:`gab.mirror`) instead
+    of from their origin: the clone and the submodule update use the mirror
+    for those urls (only those commands, later pulls go to the origin).
+    Otherwise ``env.git_depth`` makes a shallow clone with only that many
+    commits.
+
     :param str repo: git repository containing the files, default
         http://github.com/gvangool/dotfiles/
     '''
     install('git-core')
-    run('mkdir -p src')
-    run('git clone -nq %s src/dotfiles' % repo)
-    run('mv src/dotfiles/.git ~')
-    run('git reset --hard')
-    run('git submodule update --init --recursive')
-    run('rm -rf src/dotfiles/')
+    flush_install()
+    mirrors = _mirrors(repo)
+    depth = getattr(env, 'git_depth', None)
+    git = 'git' + ''.join(' -c url.%s.insteadOf=%s' % (mirror, url)
+                          for url, mirror in sorted(mirrors.items()))
+    with batch():
+        run('mkdir -p src')
+        if depth and not mirrors:
+            # a mirror is served over plain http, that can't do shallow
+            run('git clone -nq --depth %d %s src/dotfiles' % (int(depth),
+                                                             repo))
+        else:
+            run('%s clone -nq %s src/dotfiles' % (git, repo))
+        run('mv src/dotfiles/.git ~')
+        run('git reset --hard')
+        run('%s submodule update --init --recursive' % git)
+        run('rm -rf src/dotfiles/')
 
 
 def install_default_packages():
@@ -40,6 +78,7 @@ def install_python(type=''):
         MySQL-Python and PIL)
     '''
     install('python', 'python-setuptools', 'python-dev', 'build-essential')
+    flush_install()
     sudo('easy_install pip')
     sudo('pip install -U pip virtualenv virtualenvwrapper')
     if type == 'dev':
@@ -54,32 +93,34 @@ def create_python_env(env_name='generic', requirements_file=None):
     '''
     Create a python virtualenv, based on the given requirements file.
     If no requirements file is given, initialize it we some convenient packages
+    (installed from wheels, see :func:`gab.build.pip_install`).
     '''
     py_env = '~/env/%s' % env_name
     if not exists(py_env):
-        run('virtualenv --no-site-packages --distribute %s' env_name)
+        run('virtualenv --no-site-packages --distribute %s' % py_env)
+    pip = '%s/bin/pip' % py_env
     if requirements_file is None:
-        run('%s/bin/pip install ipython suds pygments httplib2 ' % py_env)
-        run('%s/bin/pip install simplejson textile markdown' % py_env)
-        run('%s/bin/pip install django bpython docutils' % py_env)
         pil_url = 'http://effbot.org/downloads/Imaging-1.1.7.tar.gz'
-        run('%s/bin/pip install Imaging==1.1.7 -f %s' % (py_env, pil_url,))
-        run('%s/bin/pip install MySQL-python pep8 fabric' % py_env)
+        _pip_install(['ipython', 'suds', 'pygments', 'httplib2', 'simplejson',
+                      'textile', 'markdown', 'django', 'bpython', 'docutils',
+                      'Imaging==1.1.7', 'MySQL-python', 'pep8', 'fabric'],
+                     pip, find_links=[pil_url])
     else:
-        run('%s/bin/pip install -r %s' % (py_env, requirements_file))
+        _pip_install(['-r', requirements_file], pip)
 
 
 def install_ruby():
     install('ruby1.8', 'libbluecloth-ruby', 'libopenssl-ruby1.8',
             'ruby1.8-dev', 'ri', 'rdoc', 'irb')
+    flush_install()
     sudo('ln -s /usr/bin/ruby1.8 /usr/bin/ruby')
     # gem install
     run('mkdir -p src')
     with cd('src'):
-        run('wget http://production.cf.rubygems.org/rubygems/rubygems-1.3.7.tgz')
-        run('tar xvzf rubygems-1.3.7.tgz')
+        _download('http://production.cf.rubygems.org/rubygems/rubygems-1.3.7.tgz')
+        run('tar xzf rubygems-1.3.7.tgz')
         with cd('rubygems-1.3.7'):
-            sudo('ruby setup.rb')
+            stream('ruby setup.rb', use_sudo=True)
             sudo('ln -s /usr/bin/gem1.8 /usr/bin/gem')
 
 
@@ -88,48 +129,64 @@ def install_duplicity(env_name='backup'):
     py_env = '~/env/%s' % env_name
     install_python()
     install('librsync-dev')
+    flush_install()
     run('pip install -E %s boto' % py_env)
     url = 'http://code.launchpad.net/duplicity/0.6-series/0.6.05/+download/duplicity-0.6.05.tar.gz'
     run('pip install -E %s %s' % (py_env, url))
 
 
-def install_nginx(version=None, remove_default=True):
+def install_nginx(version=None, remove_default=True, jobs=None):
     '''
     Install nginx as a webserver or reverse proxy
 
     :param str version: the version of nginx you want to have installed if it's
         a different version than the repository version. E.g. 1.0.4
+    :param int jobs: the number of parallel ``make`` jobs, default based on
+        the cores and memory of the host
     '''
     # install from the repository to get stable version and initial config
     install('nginx')
+    flush_install()
     default_site = '/etc/nginx/sites-enabled/default'
     if remove_default and exists(default_site):
         sudo('rm %s' % default_site)
-        restart('nginx')
+        reload('nginx')
     # if a version is specified, install that and overwrite the repo version
     if version:
+        # requirements for nginx
+        install('libc6', 'libpcre3', 'libpcrecpp0', 'libssl0.9.8', 'zlib1g',
+                'lsb-base')
+        configure_args = ' '.join(['--with-http_ssl_module',
+                                   '--with-sha1=/usr/lib',
+                                   '--with-http_gzip_static_module',
+                                   '--with-http_stub_status_module',
+                                   '--without-http_fastcgi_module',
+                                   '--sbin-path=/usr/sbin',
+                                   '--conf-path=/etc/nginx/nginx.conf',
+                                   '--prefix=/etc/nginx',
+                                   '--error-log-path=/var/log/nginx/error.log'])
+
+        def build(stage):
+            install('build-essential', 'libpcre3-dev', 'libssl-dev',
+                    'zlib1g-dev')
+            flush_install()
+            run('mkdir -p src')
+            with cd('src'):
+                _download('http://nginx.org/download/nginx-%s.tar.gz' % version)
+                run('tar xf nginx-%s.tar.gz' % version)
+                with cd('nginx-%s' % version):
+                    run('./configure %s' % configure_args)
+                    _make(jobs=jobs)
+                    run('make install DESTDIR=%s' % stage)
+            # keep the configuration of the host, only ship the defaults
+            run('find %s/etc/nginx -maxdepth 1 -type f ! -name "*.default" '
+                '-delete' % stage)
+
         stop('nginx')
-        run('mkdir -p src')
-        with cd('src'):
-            run('wget http://nginx.org/download/nginx-%s.tar.gz' % version)
-            run('tar xf nginx-%s.tar.gz' % version)
-            # requirements for nginx
-            install('build-essential', 'libc6', 'libpcre3', 'libpcre3-dev',
-                    'libpcrecpp0', 'libssl0.9.8', 'libssl-dev', 'zlib1g',
-                    'zlib1g-dev', 'lsb-base')
-            with cd('nginx-%s' % version):
-                run('''./configure --with-http_ssl_module \\
-                       --with-sha1=/usr/lib \\
-                       --with-http_gzip_static_module \\
-                       --with-http_stub_status_module \\
-                       --without-http_fastcgi_module \\
-                       --sbin-path=/usr/sbin \\
-                       --conf-path=/etc/nginx/nginx.conf \\
-                       --prefix=/etc/nginx \\
-                       --error-log-path=/var/log/nginx/error.log \\
-                       ''')
-                run('make')
-                sudo('make install')
+        # the package (with env.deb_repo) takes over the nginx binary
+        _cached_build('nginx', version, build, configure_args,
+                      replaces='nginx-common, nginx-full, nginx-light, '
+                               'nginx-extras')
         start('nginx')
 
 
@@ -148,14 +205,16 @@ def install_apache2(type='python'):
     elif type == 'ruby':
         install_ruby()
         install('apache2-dev')
+        flush_install()
         sudo('gem install passenger')
         sudo('passenger-install-apache2-module')
         sudo('a2enmod passenger')
+    flush_install()
     # enable some extra modules
     sudo('a2enmod expires')
     # we want rid of the default apache config
     sudo('a2dissite default')
-    restart('apache2')
+    reload('apache2')
 
 
 def install_mysql():
@@ -179,30 +238,41 @@ def install_apt_cacher():
     install('apt-cacher-ng')
 
 
-def install_tmux(version='1.8'):
+def install_tmux(version='1.8', jobs=None):
     '''
     Get and install the latest tmux
 
     :param str version: the tmux version to install. Default: 1.8
+    :param int jobs: the number of parallel ``make`` jobs, default based on
+        the cores and memory of the host
     '''
-    install('build-essential', 'libevent-dev', 'ncurses-dev', 'ncurses-term')
-    run('mkdir -p src')
-    with cd('src'):
-        run('wget http://downloads.sourceforge.net/project/tmux/tmux/tmux-%(version)s/tmux-%(version)s.tar.gz?use_mirror=heanet -O tmux-%(version)s.tar.gz' % {'version': version})
-        run('tar xf tmux-%s.tar.gz' % version)
-        with cd('tmux-%s' % version):
-            run('./configure')
-            run('make')
-    run('mkdir -p bin')
-    run('mkdir -p share/man/man1/')
-    run('cp ~/src/tmux-%s/tmux ~/bin/' % version)
-    run('cp ~/src/tmux-%s/tmux.1 ~/share/man/man1/' % version)
+    install('libevent-dev', 'ncurses-dev', 'ncurses-term')
+
+    def build(stage):
+        install('build-essential')
+        flush_install()
+        run('mkdir -p src')
+        with cd('src'):
+            _download('http://downloads.sourceforge.net/project/tmux/tmux/tmux-%(version)s/tmux-%(version)s.tar.gz?use_mirror=heanet' % {'version': version},
+                      'tmux-%s.tar.gz' % version)
+            run('tar xf tmux-%s.tar.gz' % version)
+            with cd('tmux-%s' % version):
+                run('./configure')
+                _make(jobs=jobs)
+                run('mkdir -p %(stage)s/bin %(stage)s/share/man/man1' %
+                    {'stage': stage})
+                run('cp tmux %s/bin/' % stage)
+                run('cp tmux.1 %s/share/man/man1/' % stage)
+
+    # tmux is installed in the home directory
+    _cached_build('tmux', version, build, root='~')
 
 
 def install_latex():
     '''Install LaTeX'''
     install('texlive', 'texlive-font*', 'texlive-latex*')
-    if getattr(env, 'editor', 'vim') == 'vim':
+    editor = getattr(env, 'editor', None) or _facts()['editor'] or 'vim'
+    if editor.startswith('vim'):
         install('vim-latexsuite')
 
 
@@ -220,16 +290,17 @@ def install_cdripper():
     version = '0.5.7'
     install('build-essential', 'cd-discid', 'cdparanoia', 'flac', 'lame',
             'mp3gain', 'normalize-audio', 'ruby-gnome2', 'ruby', 'vorbisgain')
+    flush_install()
     run('mkdir -p src')
     with cd('src'):
         url = 'http://rubyripper.googlecode.com/files/rubyripper-%s.tar.bz2' % version
-        run('wget %s' % url)
+        _download(url)
         run('bzip2 -d rubyripper-%s.tar.bz2' % version)
         run('tar xf rubyripper-%s.tar' % version)
         with cd('rubyripper-%s' % version):
             # default options: gui + command line
             run('./configure --enable-lang-all --enable-gtk2 --enable-cli')
-            sudo('make install')
+            _make('install', use_sudo=True)
 
 
 def install_dvdripper():
@@ -238,7 +309,8 @@ def install_dvdripper():
         sudo('wget http://www.medibuntu.org/sources.list.d/$(lsb_release -cs).list --output-document=/etc/apt/sources.list.d/medibuntu.list')
         apt_update()
         install('medibuntu-keyring', allow_unauthenticated=True)
-        apt_update()
+        # the sources didn't change, but now we can verify them
+        apt_update(force=True)
     install('libdvdcss2')
     install('k9copy')
 
@@ -260,6 +332,7 @@ def install_moc(add_lastfm=True):
     install(*apps)
 
     if add_lastfm:
+        flush_install()
         username = prompt('Last.fm username?', validate=lambda v: _validate_not_empty(v, key='username'))
         password = prompt('Last.fm password?', validate=lambda v: _validate_not_empty(v, key='password'))
         # create lastfm config
@@ -273,7 +346,7 @@ def install_moc(add_lastfm=True):
         # when we're half way through)
         run('mkdir -p ~/.moc')
         with cd('~/.moc'):
-            run('wget http://files.lukeplant.fastmail.fm/public/moc_submit_lastfm')
+            _download('http://files.lukeplant.fastmail.fm/public/moc_submit_lastfm')
             run('chmod a+x moc_submit_lastfm')
             append('config',
                    'OnSongChange = "/home/%(user)s/.moc/moc_submit_lastfm --artist %%a --title %%t --length %%d --album %%r"' % env)
@@ -284,24 +357,30 @@ def install_systools():
     install('htop', 'iotop', 'sysstat', 'nethogs')
 
 
-def install_memcached(version='1.4.9', daemon=False):
+def install_memcached(version='1.4.9', daemon=False, jobs=None):
     'Install memcached server'
     if not exists('/usr/bin/memcached'):
-        install('libevent-dev', 'build-essential')
-        run('mkdir -p src')
-        with cd('src'):
-            run('wget http://memcached.googlecode.com/files/memcached-%s.tar.gz' % version)
-            run('tar xf memcached-%s.tar.gz' % version)
-            with cd('memcached-%s' % version):
-                args = ['--prefix=', '--exec-prefix=/usr',
-                        '--datarootdir=/usr']
-                if getattr(env, 'is_64bit', False):
-                    args.append('--enable-64bit')
-                run('./configure %s' % ' '.join(args))
-                run('make')
-                sudo('make install')
-                sudo('mkdir -p /usr/share/memcached')
-                sudo('cp -R scripts /usr/share/memcached')
+        install('libevent-dev')
+        args = ['--prefix=', '--exec-prefix=/usr', '--datarootdir=/usr']
+        if _facts()['arch'] == 'x86_64':
+            args.append('--enable-64bit')
+        configure_args = ' '.join(args)
+
+        def build(stage):
+            install('build-essential')
+            flush_install()
+            run('mkdir -p src')
+            with cd('src'):
+                _download('http://memcached.googlecode.com/files/memcached-%s.tar.gz' % version)
+                run('tar xf memcached-%s.tar.gz' % version)
+                with cd('memcached-%s' % version):
+                    run('./configure %s' % configure_args)
+                    _make(jobs=jobs)
+                    run('make install DESTDIR=%s' % stage)
+                    run('mkdir -p %s/usr/share/memcached' % stage)
+                    run('cp -R scripts %s/usr/share/memcached' % stage)
+
+        _cached_build('memcached', version, build, configure_args)
 
     if daemon:
         sudo('cp /usr/share/memcached/scripts/memcached-init /etc/init.d/memcached')
@@ -309,23 +388,29 @@ def install_memcached(version='1.4.9', daemon=False):
         start('memcached')
 
 
-def install_memcached_client(version='0.53'):
+def install_memcached_client(version='0.53', jobs=None):
     'Install libmemcached as client library for memcached'
     if not exists('/usr/bin/memcached'):
         install_memcached()
-    install('libevent-dev', 'build-essential')
-    run('mkdir -p src')
-    with cd('src'):
-        v = {'version': version}
-        run('wget http://launchpad.net/libmemcached/1.0/%(version)s/+download/libmemcached-%(version)s.tar.gz' % v)
-        run('tar xf libmemcached-%(version)s.tar.gz' % v)
-        with cd('libmemcached-%(version)s' % v):
-            run('./configure')
-            run('make')
-            sudo('make install')
+    install('libevent-dev')
+
+    def build(stage):
+        install('build-essential')
+        flush_install()
+        run('mkdir -p src')
+        with cd('src'):
+            v = {'version': version}
+            _download('http://launchpad.net/libmemcached/1.0/%(version)s/+download/libmemcached-%(version)s.tar.gz' % v)
+            run('tar xf libmemcached-%(version)s.tar.gz' % v)
+            with cd('libmemcached-%(version)s' % v):
+                run('./configure')
+                _make(jobs=jobs)
+                run('make install DESTDIR=%s' % stage)
+
+    _cached_build('libmemcached', version, build)
     if not exists('/etc/ld.so.conf.d/local_lib'):
         append('/etc/ld.so.conf.d/local_lib', '/usr/local/lib/', use_sudo=True)
-        sudo('ldconfig')
+    sudo('ldconfig')
 
 
 def install_memcached_client_python():
@@ -333,35 +418,43 @@ def install_memcached_client_python():
     if not exists('/usr/local/lib/libmemcached.so'):
         install_memcached_client('0.50')
     install('python', 'python-setuptools', 'python-dev', 'build-essential', 'zlib1g-dev')
+    flush_install()
     if hasattr(env, 'virtual_env') and exists(env.virtual_env):
-        run('%(virtual_env)s/bin/pip install pylibmc' % env)
+        _pip_install(['pylibmc'], '%(virtual_env)s/bin/pip' % env)
     else:
-        sudo('pip install pylibmc')
+        _pip_install(['pylibmc'], use_sudo=True)
 
 
-def install_redis(version):
+def install_redis(version, jobs=None):
     'Install redis server'
-    run('mkdir -p src')
-    with cd('src'):
-        v = {'version': version}
-        run('wget http://redis.googlecode.com/files/redis-%(version)s.tar.gz' % v)
-        run('tar xzf redis-%(version)s.tar.gz' % v)
-        with cd('redis-%(version)s' % v):
-            run('make')
-            sudo('make install')
+    def build(stage):
+        install('build-essential')
+        flush_install()
+        run('mkdir -p src')
+        with cd('src'):
+            v = {'version': version}
+            _download('http://redis.googlecode.com/files/redis-%(version)s.tar.gz' % v)
+            run('tar xzf redis-%(version)s.tar.gz' % v)
+            with cd('redis-%(version)s' % v):
+                _make(jobs=jobs)
+                run('make PREFIX=%s/usr/local install' % stage)
+
+    _cached_build('redis', version, build)
 
 
 def install_solr():
     '''Install SOLR: http://lucene.apache.org/solr/'''
     install('solr-jetty', 'openjdk-6-jdk')
+    flush_install()
     sed('/etc/default/jetty', 'NO_START=1', 'NO_START=0', use_sudo=True)
     append('/etc/default/jetty', 'JETTY_HOST=0.0.0.0', use_sudo=True)
     # move configuration files to current users dir
-    run('mkdir -p etc/solr/conf')
-    for f in ('etc/solr/conf/schema.xml', 'etc/solr/conf/solrconfig.xml'):
-        run('cp /%(f)s ~/%(f)s' % {'f': f})
-        sudo('mv /%(f)s /%(f)s~' % {'f': f})
-        sudo('ln -s ~/%(f)s /%(f)s' % {'f': f})
+    with batch():
+        run('mkdir -p etc/solr/conf')
+        for f in ('etc/solr/conf/schema.xml', 'etc/solr/conf/solrconfig.xml'):
+            run('cp /%(f)s ~/%(f)s' % {'f': f})
+            sudo('mv /%(f)s /%(f)s~' % {'f': f})
+            sudo('ln -s ~/%(f)s /%(f)s' % {'f': f})
 
 
 def install_rabbitmq(user, password, vhost):
@@ -373,12 +466,14 @@ def install_rabbitmq(user, password, vhost):
         sudo('wget http://www.rabbitmq.com/rabbitmq-signing-key-public.asc -O - | apt-key add -')
         apt_update()
     install('rabbitmq-server', 'erlang-inets')
-    # create the user & make it the admin
-    create_rabbitmq_user(user, password, admin=True)
-    # create the vhost
-    create_rabbitmq_vhost(vhost, user)
-    # delete guest user for safety
-    sudo('rabbitmqctl delete_user guest')
+    flush_install()
+    with batch():
+        # create the user & make it the admin
+        create_rabbitmq_user(user, password, admin=True)
+        # create the vhost
+        create_rabbitmq_vhost(vhost, user)
+        # delete guest user for safety
+        sudo('rabbitmqctl delete_user guest')
     install_rabbitmq_plugins()
 
 
@@ -393,7 +488,8 @@ def install_rabbitmq_plugins():
         'http://www.rabbitmq.com/releases/plugins/v2.6.1/rabbitmq_management_agent-2.6.1.ez',
     )
     for file in plugin_files:
-        sudo('wget %s -P %s' % (file, plugin_dir,))
+        _download(file, '%s/%s' % (plugin_dir, os.path.basename(file)),
+                  use_sudo=True)
     # restart rabbitmq to load plugin
     restart('rabbitmq-server')
 
@@ -406,6 +502,7 @@ def install_uwsgi():
     .. _uWSGI: http://projects.unbit.it/uwsgi/
     '''
     install('libxml2-dev')
+    flush_install()
     run('pip install -E ~/env/uwsgi_test uwsgi')
 
 
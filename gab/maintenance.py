@@ -1,17 +1,98 @@
+from contextlib import contextmanager
+from urlparse import urlparse
+
 from fabric.api import *
-from fabric.contrib.files import exists
 
+from gab.facts import facts, forget as _forget_facts, _from_disk
+from gab.remote import run, sudo, stream
 from gab.validators import yes_or_no as _yes_or_no
 
 
+__all__ = ['update', 'apt_update', 'apt_upgrade', 'install', 'flush_install',
+           'apt_cacher_stats']
+
+
+#: touched by :func:`apt_update` after every refresh of the package lists
+#: (apt leaves dot files in its lists directory alone), the lists are as old
+#: as this file: an update of only some lists (e.g. the one of
+#: :func:`gab.build.package_build`) doesn't touch it
+APT_UPDATE_STAMP = '/var/lib/apt/lists/.gab-update-stamp'
+#: default maximum age (in seconds) of the package lists before
+#: :func:`apt_update` refreshes them, override with ``env.apt_update_ttl``
+APT_UPDATE_TTL = 3600
+#: seconds to wait for the apt proxy (``env.apt_proxy``) before fetching
+#: directly, override with ``env.apt_proxy_timeout``
+APT_PROXY_TIMEOUT = 3
+
+#: packages collected by :func:`install` while :func:`deferred_install` is
+#: active. Per host a list of ``[apt-get arguments, [package, ...]]``.
+_package_queue = {}
+#: how deep we are nested in :func:`deferred_install`, per host
+_defer_depth = {}
+#: locks (per host) to run only one ``apt-get`` at a time when steps run in
+#: parallel, see :func:`gab.graph.run_steps`
+_apt_locks = {}
+#: hosts that couldn't reach ``env.apt_proxy`` in this run
+_apt_proxy_down = set()
+
+
+def _apt_proxy():
+    '''
+    The apt proxy (``env.apt_proxy``) as url, e.g. ``http://cache.lan:3142``
+    for ``cache.lan``. ``None`` if there is none or if the current host
+    couldn't reach it earlier in this run.
+    '''
+    proxy = getattr(env, 'apt_proxy', None)
+    if not proxy or env.host_string in _apt_proxy_down:
+        return None
+    if '://' not in proxy:
+        proxy = 'http://%s' % proxy
+    if urlparse(proxy).port is None:
+        proxy = '%s:3142' % proxy.rstrip('/')
+    return proxy
+
+
 def _apt_get(cmd):
     '''
     Wrapper for ``apt-get``. This will set the :envvar:`DEBIAN_FRONTEND` to
     ``noninteractive``.
 
+    When ``env.apt_proxy`` is set (an apt-cacher-ng server, e.g.
+    ``cache.lan`` or ``http://cache.lan:3142``), the packages are fetched
+    through it. If the host can't connect to it within
+    ``env.apt_proxy_timeout`` seconds (default :data:`APT_PROXY_TIMEOUT`),
+    they're fetched directly, for the rest of the run.
+
+    The output is streamed, see :func:`gab.remote.stream`.
+
     :param str cmd: the rest of the ``apt-get`` command
     '''
-    return sudo('export DEBIAN_FRONTEND=noninteractive; apt-get %s' % cmd)
+    cmd = 'export DEBIAN_FRONTEND=noninteractive; apt-get %s' % cmd
+    proxy = _apt_proxy()
+    if proxy:
+        url = urlparse(proxy)
+        timeout = int(getattr(env, 'apt_proxy_timeout', APT_PROXY_TIMEOUT))
+        # the check is a connect from the host, it costs no extra round trip
+        cmd = ("if timeout %d bash -c '</dev/tcp/%s/%d' 2>/dev/null; "
+               "then proxy='-o Acquire::http::Proxy=%s'; "
+               "else echo 'gab-apt-proxy: down'; proxy=''; fi; %s" % (
+                   timeout, url.hostname, url.port, proxy,
+                   cmd.replace('apt-get ', 'apt-get $proxy ', 1)))
+    down = []
+
+    def on_line(line):
+        if line == 'gab-apt-proxy: down':
+            down.append(line)
+    lock = _apt_locks.get(env.host_string)
+    if lock is None:
+        result = stream(cmd, use_sudo=True, on_line=on_line)
+    else:
+        with lock:
+            result = stream(cmd, use_sudo=True, on_line=on_line)
+    if down:
+        warn('The apt proxy %s is down, fetching directly' % proxy)
+        _apt_proxy_down.add(env.host_string)
+    return result
 
 
 def update(dselect=False):
@@ -25,9 +106,57 @@ def update(dselect=False):
     apt_upgrade(dselect)
 
 
-def apt_update():
-    'Update apt repositories'
-    _apt_get('update -q')
+def apt_update(force=False):
+    '''
+    Update apt repositories. This is skipped when the package lists are
+    younger than ``env.apt_update_ttl`` seconds (default
+    :data:`APT_UPDATE_TTL`) and none of the apt sources changed since then.
+
+    Packages that are still queued by :func:`deferred_install` are installed
+    first, so they come from the repositories that were configured when they
+    were requested.
+
+    :param bool force: update, no matter how fresh the lists are
+    :return: whether the lists were actually updated
+    :rtype: bool
+    '''
+    flush_install()
+    if not force:
+        age = _apt_lists_age()
+        if age is not None:
+            puts('Package lists are %s seconds old, not updating' % age)
+            return False
+    _apt_get('update -q && touch %s' % APT_UPDATE_STAMP)
+    return True
+
+
+def _apt_lists_age():
+    '''
+    Find the age of the package lists on the current host, since the last
+    full update (:data:`APT_UPDATE_STAMP`).
+
+    :return: the age in seconds, or ``None`` if the lists are older than the
+        TTL, if a source (``/etc/apt/sources.list*``) changed after the
+        last update or if gab never updated them
+    '''
+    ttl = int(getattr(env, 'apt_update_ttl', APT_UPDATE_TTL))
+    if ttl <= 0:
+        return None
+    newest = 'stat -c %%Y %s 2>/dev/null | sort -n | tail -1'
+    cmd = 'echo $(date +%%s) $(%s) $(%s)' % (
+        newest % APT_UPDATE_STAMP,
+        newest % '/etc/apt/sources.list /etc/apt/sources.list.d '
+                 '/etc/apt/sources.list.d/*',
+    )
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run(cmd)
+    try:
+        now, lists, sources = [int(v) for v in output.split()]
+    except ValueError:
+        return None
+    if sources > lists or now - lists >= ttl:
+        return None
+    return now - lists
 
 
 def apt_upgrade(dselect=False):
@@ -38,6 +167,8 @@ def apt_upgrade(dselect=False):
         ``apt-get dselect-upgrade`` behaviour.
     '''
     _apt_get('upgrade -yq')
+    # versions changed, reload them when needed
+    _forget_facts()
     if dselect:
         # download only
         _apt_get('dselect-upgrade -yqd')
@@ -49,6 +180,43 @@ def apt_upgrade(dselect=False):
             _apt_get('dselect-upgrade -yqq')
 
 
+def apt_cacher_stats(log='/var/log/apt-cacher-ng/apt-cacher.log'):
+    '''
+    Print how many requests the apt-cacher-ng server on the current host
+    answered from its cache, e.g.::
+
+        fab -H cache.lan apt_cacher_stats
+
+    :param str log: the transfer log of apt-cacher-ng
+    :return: a dict with the number of files (and bytes) ``served`` to the
+        hosts and ``fetched`` from the internet
+    :rtype: dict
+    '''
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = sudo("awk -F'|' '"
+                      '$2 == "O" {served++; served_bytes += $3} '
+                      '$2 == "I" {fetched++; fetched_bytes += $3} '
+                      'END {print served+0, served_bytes+0, fetched+0, '
+                      "fetched_bytes+0}' %s" % log)
+    try:
+        served, served_bytes, fetched, fetched_bytes = [
+            int(float(v)) for v in output.split()]
+    except ValueError:
+        abort('Can\'t read the apt-cacher-ng log %s' % log)
+    if served:
+        hits = max(served - fetched, 0)
+        puts('%d files served, %d from the cache (%d%%)' % (
+            served, hits, 100 * hits / served))
+        puts('%.1f MB served, %.1f MB fetched from the internet (%d%% saved)'
+             % (served_bytes / 1048576.0, fetched_bytes / 1048576.0,
+                100 * max(served_bytes - fetched_bytes, 0) / served_bytes
+                if served_bytes else 0))
+    else:
+        puts('Nothing served yet')
+    return {'served': served, 'served_bytes': served_bytes,
+            'fetched': fetched, 'fetched_bytes': fetched_bytes}
+
+
 def install(*package_list, **options):
     '''
     Install packages
@@ -56,6 +224,11 @@ def install(*package_list, **options):
     :param list package_list: a list of packages to install
     :param dict options: pass extra options to ``apt-get``. Supported options:
         ``allow_unauthenticated`` (``True`` or ``False``)
+
+    Packages that are already installed are skipped, if none are left
+    ``apt-get`` isn't called at all. Inside :func:`deferred_install` the
+    packages are only queued, call :func:`flush_install` before running
+    anything that needs them.
     '''
     if len(package_list) == 0:
         return
@@ -63,5 +236,139 @@ def install(*package_list, **options):
     args = '-yq'
     if options.get('allow_unauthenticated', False):
         args += ' --allow-unauthenticated'
-    package_list = ' '.join(package_list)
-    _apt_get('install %s %s' % (args, package_list,))
+    if _defer_depth.get(env.host_string, 0):
+        _queue_packages(args, package_list)
+    else:
+        _apt_install(args, package_list)
+
+
+def _installed_packages():
+    '''
+    The packages installed on the current host, part of the
+    :func:`gab.facts.facts` and kept up to date by :func:`_apt_install`.
+    Facts from an earlier run (``env.facts_ttl``) are gathered again first,
+    packages may have been removed since.
+
+    :return: a dict with the package name as key and its version as value
+    :rtype: dict
+    '''
+    return facts(refresh=env.host_string in _from_disk)['packages']
+
+
+def _split_package(package):
+    '''
+    Split a package as passed to :func:`install` in its name and version.
+
+    :param str package: the package, e.g. ``nginx`` or ``nginx=1.0.4-1``
+    :return: a tuple with the name and the version (``None`` if not given)
+    :rtype: tuple
+    '''
+    if '=' in package:
+        return tuple(package.split('=', 1))
+    return (package, None)
+
+
+def _missing_packages(package_list):
+    '''
+    Filter out the packages that are already installed (at the requested
+    version, if any) on the current host. Patterns (e.g. ``texlive-font*``)
+    and release selections (e.g. ``nginx/testing``) are always kept.
+
+    :param list package_list: the packages we want
+    :return: the packages that still need to be installed
+    :rtype: list
+    '''
+    installed = _installed_packages()
+    missing = []
+    for package in package_list:
+        name, version = _split_package(package)
+        if any(c in name for c in '*?[]/'):
+            missing.append(package)
+        elif name not in installed:
+            missing.append(package)
+        elif version is not None and installed[name] != version:
+            missing.append(package)
+    return missing
+
+
+def _apt_install(args, package_list):
+    '''
+    Install the packages that aren't installed yet and remember them.
+
+    :param str args: the ``apt-get`` arguments
+    :param list package_list: the packages to install
+    '''
+    package_list = _missing_packages(package_list)
+    if not package_list:
+        return
+    _apt_get('install %s %s' % (args, ' '.join(package_list),))
+    installed = _installed_packages()
+    for package in package_list:
+        name, version = _split_package(package)
+        if not any(c in name for c in '*?[]/'):
+            installed[name] = version
+
+
+def _queue_packages(args, package_list):
+    '''
+    Add packages to the queue of the current host, skipping the ones that are
+    already queued.
+
+    :param str args: the ``apt-get`` arguments for these packages
+    :param list package_list: the packages to queue
+    '''
+    queue = _package_queue.setdefault(env.host_string, [])
+    queued = set()
+    for entry_args, packages in queue:
+        queued.update(packages)
+    new = []
+    for package in package_list:
+        if package not in queued:
+            queued.add(package)
+            new.append(package)
+    if not new:
+        return
+    for entry in queue:
+        if entry[0] == args:
+            entry[1].extend(new)
+            return
+    queue.append([args, new])
+
+
+def flush_install():
+    '''
+    Install all packages queued by :func:`deferred_install` on the current
+    host, using one ``apt-get install`` per set of options. Does nothing if
+    nothing is queued.
+    '''
+    for args, packages in _package_queue.pop(env.host_string, []):
+        _apt_install(args, packages)
+
+
+@contextmanager
+def deferred_install():
+    '''
+    Collect all :func:`install` calls and install them in one transaction
+    when leaving the block (or earlier, on :func:`flush_install`). This saves
+    a round trip, a dependency solve and a run of the dpkg triggers per
+    call. Nesting is allowed, only the outer block installs.
+
+    Example::
+
+        with deferred_install():
+            install_vcs()
+            install_systools()
+    '''
+    host = env.host_string
+    _defer_depth[host] = _defer_depth.get(host, 0) + 1
+    try:
+        yield
+    except:
+        _defer_depth[host] -= 1
+        if not _defer_depth[host]:
+            # don't leave half a recipe behind for the next one
+            _package_queue.pop(host, None)
+        raise
+    _defer_depth[host] -= 1
+    if not _defer_depth[host]:
+        flush_install()
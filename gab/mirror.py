@@ -0,0 +1,129 @@
+import re
+import urlparse
+
+from fabric.api import env, settings, hide, abort, puts, runs_once
+
+from gab.remote import sudo
+
+
+__all__ = ['update_git_mirror']
+
+
+#: directory on the ``env.git_mirror`` node with the bare mirrors, override
+#: with ``env.git_mirror_dir``
+MIRROR_DIR = '/var/www/git'
+
+#: the url of the mirror and the urls of the submodules of every repository
+#: that was updated in this run
+_mirrored = {}
+
+
+def _mirror_url():
+    '''The url of the mirrors on the ``env.git_mirror`` node for the hosts'''
+    url = getattr(env, 'git_mirror_url', None)
+    if not url:
+        url = 'http://%s/git' % env.git_mirror.split('@')[-1].split(':')[0]
+    return url.rstrip('/')
+
+
+def _name(url):
+    '''
+    The name of the mirror of a repository, e.g.
+    ``github.com/gvangool/dotfiles.git``
+
+    :param str url: the url of the repository
+    '''
+    name = re.sub(r'^\w+://([^@/]+@)?|^[^@/]+@', '', url.rstrip('/'))
+    name = name.replace(':', '/')
+    if not name.endswith('.git'):
+        name += '.git'
+    return name
+
+
+def _submodules(url, gitmodules):
+    '''
+    The urls of the submodules in a ``.gitmodules`` file
+
+    :param str url: the url of the repository, for the relative urls
+    :param str gitmodules: the content of the ``.gitmodules`` file
+    '''
+    urls = re.findall(r'^\s*url\s*=\s*(\S+)\s*$', gitmodules, re.M)
+    return [urlparse.urljoin(url.rstrip('/') + '/', u)
+            if u.startswith(('./', '../')) else u for u in urls]
+
+
+def _update(url):
+    '''
+    Create or refresh the mirror of a repository on the ``env.git_mirror``
+    node. Refreshing only fetches what changed since the last time.
+
+    :param str url: the url of the repository
+    :return: the content of its ``.gitmodules`` file (if any)
+    :rtype: str
+    '''
+    path = '%s/%s' % (getattr(env, 'git_mirror_dir', MIRROR_DIR), _name(url))
+    v = {'path': path, 'url': url, 'parent': path.rsplit('/', 1)[0]}
+    # the lock keeps hosts in parallel from updating the same mirror at once,
+    # update-server-info makes it available over plain http
+    with settings(hide('running', 'stdout'), host_string=env.git_mirror):
+        return sudo('mkdir -p %(parent)s && (flock 9 && '
+                    'if [ -d %(path)s ]; then '
+                    'git --git-dir=%(path)s fetch -q --prune; '
+                    'else git clone -q --mirror %(url)s %(path)s; fi && '
+                    'git --git-dir=%(path)s update-server-info) '
+                    '9>%(path)s.lock && '
+                    '{ git --git-dir=%(path)s show HEAD:.gitmodules '
+                    '2>/dev/null || true; }' % v)
+
+
+def mirrors(url):
+    '''
+    The mirrors of a repository and its submodules (recursively) on the
+    ``env.git_mirror`` node, they're updated the first time they're needed
+    in a run.
+
+    :param str url: the url of the repository
+    :return: a dict with the original url as key and the url of the mirror
+        as value, empty if ``env.git_mirror`` isn't set
+    :rtype: dict
+    '''
+    if not getattr(env, 'git_mirror', None):
+        return {}
+    result = {}
+    todo = [url]
+    while todo:
+        url = todo.pop(0)
+        if url in result:
+            continue
+        if url not in _mirrored:
+            puts('Updating the mirror of %s' % url)
+            _mirrored[url] = (
+                '%s/%s' % (_mirror_url(), _name(url)),
+                _submodules(url, _update(url)))
+        result[url] = _mirrored[url][0]
+        todo.extend(_mirrored[url][1])
+    return result
+
+
+@runs_once
+def update_git_mirror(*repos):
+    '''
+    Create or refresh the mirrors of git repositories (and their submodules)
+    on the ``env.git_mirror`` node, e.g.::
+
+        fab --set git_mirror=mirror.lan update_git_mirror:http://github.com/gvangool/dotfiles.git
+
+    The mirrors are bare repositories in ``env.git_mirror_dir`` (default
+    :data:`MIRROR_DIR`), served over http by the web server on the node
+    (``env.git_mirror_url``, default ``http://<env.git_mirror>/git``), see
+    :func:`gab.setup.setup_git_mirror`. Tasks that clone a repository (e.g.
+    :func:`gab.install.install_dotfiles`) update its mirror themselves, once
+    per run.
+
+    :param repos: the urls of the repositories
+    '''
+    if not getattr(env, 'git_mirror', None):
+        abort('Set env.git_mirror to the node with the mirrors')
+    for repo in repos:
+        _mirrored.pop(repo, None)
+        mirrors(repo)
@@ -1,7 +1,12 @@
 import os
 
-from fabric.api import sudo, run, put
-from fabric.contrib.files import append, exists
+from gab.remote import run, sudo, exists, batch, sync
+
+
+__all__ = ['shell', 'set_hostname', 'set_apt_proxy', 'create_user',
+           'delete_user', 'install_crontab', 'remove_crontab',
+           'install_nginx_config', 'create_rabbitmq_user',
+           'create_rabbitmq_vhost', 'add_ssh_config']
 
 
 def shell(cmd):
@@ -18,9 +23,10 @@ def set_hostname(new_hostname):
 
     :param str new_hostname: the hostname for the server
     '''
-    sudo('echo %s > /etc/hostname' % new_hostname)
-    sudo('echo 127.0.1.1\t%s >> /etc/hosts' % new_hostname)
-    sudo('hostname -F /etc/hostname')
+    with batch():
+        sudo('echo %s > /etc/hostname' % new_hostname)
+        sudo('echo 127.0.1.1\t%s >> /etc/hosts' % new_hostname)
+        sudo('hostname -F /etc/hostname')
 
 
 def set_apt_proxy(host):
@@ -43,15 +49,16 @@ def create_user(username, password='password', is_admin=True):
     :param str password: the password for the user, default is ``password`` (optional)
     :param bool is_admin: should the user have ``sudo`` rights
     '''
-    # create user
-    sudo('useradd -U -m -s /bin/bash %s' % username)
-    # set password
-    sudo('echo "%s:%s" | chpasswd' % (username, password))
-    if is_admin:
-        # add to admin group (sudoers)
-        sudo('adduser %s admin' % username)
-        # add to adm group (administrators)
-        sudo('adduser %s adm' % username)
+    with batch():
+        # create user
+        sudo('useradd -U -m -s /bin/bash %s' % username)
+        # set password
+        sudo('echo "%s:%s" | chpasswd' % (username, password))
+        if is_admin:
+            # add to admin group (sudoers)
+            sudo('adduser %s admin' % username)
+            # add to adm group (administrators)
+            sudo('adduser %s adm' % username)
 
 
 def delete_user(username):
@@ -69,22 +76,19 @@ def delete_user(username):
 
 def install_crontab(remote, local=None):
     '''
-    Install the cron file
+    Install the cron file, unless it's the crontab already
 
     :param str remote: the server file containing the crontab information
     :param str local: the local file containing that servers crontab
-        information. This file will be uploaded to ``remote``.
+        information. This file will be uploaded to ``remote`` (if it changed).
     '''
     if local and os.path.exists(local):
-        # check whether we need to create directories
-        remote_path = os.path.dirname(remote)
-        if remote_path:
-            run('mkdir -p %s' % remote_path)
-        put(local, remote)
-    if not exists(remote.replace('~/', '')):
+        sync(local, remote)
+    elif not exists(remote.replace('~/', '')):
         return
 
-    run('crontab %s' % (remote,))
+    run('crontab -l 2>/dev/null | cmp -s - %s || crontab %s' % (remote,
+                                                               remote))
 
 
 def remove_crontab():
@@ -94,7 +98,7 @@ def remove_crontab():
 
 def install_nginx_config(path, site_name, id='00'):
     '''Install nginx config'''
-    from gab.services import restart
+    from gab.services import reload
     if not exists(path):
         return
 
@@ -107,7 +111,7 @@ def install_nginx_config(path, site_name, id='00'):
         sudo('ln -s %s %s' % (path, available))
     if not exists(enabled):
         sudo('ln -s %s %s' % (available, enabled))
-    restart('nginx')
+    reload('nginx')
 
 
 def create_rabbitmq_user(user, password, admin):
@@ -118,11 +122,12 @@ def create_rabbitmq_user(user, password, admin):
     :param password str: the password for the given user
     :param admin bool: do we want to make the user an admin?
     '''
-    # create user
-    sudo('rabbitmqctl add_user %s %s' % (user, password,))
-    # make it the admin
-    if admin:
-        sudo('rabbitmqctl set_admin %s' % user)
+    with batch():
+        # create user
+        sudo('rabbitmqctl add_user %s %s' % (user, password,))
+        # make it the admin
+        if admin:
+            sudo('rabbitmqctl set_admin %s' % user)
 
 
 def create_rabbitmq_vhost(vhost, user):
@@ -133,10 +138,11 @@ def create_rabbitmq_vhost(vhost, user):
     :param vhost str: the vhost
     :param user str: the username
     '''
-    # create vhost
-    sudo('rabbitmqctl add_vhost %s' % vhost)
-    # add permissions for user to vhost
-    sudo('rabbitmqctl set_permissions -p %s %s \'.*\' \'.*\' \'.*\'' % (vhost, user,))
+    with batch():
+        # create vhost
+        sudo('rabbitmqctl add_vhost %s' % vhost)
+        # add permissions for user to vhost
+        sudo('rabbitmqctl set_permissions -p %s %s \'.*\' \'.*\' \'.*\'' % (vhost, user,))
 
 
 def add_ssh_config(hostname, username, identity_file):
@@ -161,8 +167,9 @@ def add_ssh_config(hostname, username, identity_file):
     :param identity_file str: the location to the private key file
     '''
     v = {'host': hostname, 'user': username, 'key': identity_file, }
-    run('echo "Host %(host)s\n'
-        '\tUser %(user)s\n'
-        '\tHostname %(host)s\n'
-        '\tIdentityFile %(key)s" >> ~/.ssh/config' % v)
-    run('ssh-keyscan %s >> .ssh/known_hosts' % hostname)
+    with batch():
+        run('echo "Host %(host)s\n'
+            '\tUser %(user)s\n'
+            '\tHostname %(host)s\n'
+            '\tIdentityFile %(key)s" >> ~/.ssh/config' % v)
+        run('ssh-keyscan %s >> .ssh/known_hosts' % hostname)
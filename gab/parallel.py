@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+
+from fabric.api import env, execute, runs_once, abort, puts
+from fabric.decorators import parallel
+from fabric import state
+from fabric.task_utils import crawl
+
+from gab import pool, remote
+
+
+__all__ = ['run_parallel']
+
+
+#: default number of hosts that are handled at the same time, override with
+#: ``env.pool_size`` (``fab -z``)
+POOL_SIZE = 10
+#: default directory for the per host output, override with
+#: ``env.parallel_log_dir``
+LOG_DIR = 'logs'
+
+
+def _log_file(host):
+    '''
+    The file that receives all output for ``host``
+
+    :param str host: the host string
+    '''
+    log_dir = getattr(env, 'parallel_log_dir', LOG_DIR)
+    name = host.replace(os.sep, '_').replace(':', '_')
+    return os.path.join(log_dir, '%s.log' % name)
+
+
+def _run_isolated(func, args, kwargs):
+    '''
+    Run ``func`` for the current host with its output sent to the host's log
+    file. Failures (including :func:`abort`) are caught, so they only fail
+    this host.
+
+    :return: a dict with the ``status`` (``ok`` or ``failed``), the
+        ``duration`` in seconds, the ``error`` (if any), the ``log`` file,
+        the ``result`` of ``func``, the ``timings`` of the remote
+        operations and the ``ssh`` statistics (see :mod:`gab.pool`)
+    :rtype: dict
+    '''
+    # the timings this process inherited are already in the parent
+    inherited = len(remote._timings)
+    inherited_ssh = dict(pool._stats)
+    info = {'status': 'ok', 'error': '', 'result': None,
+            'log': _log_file(env.host_string)}
+    start = time.time()
+    log = open(info['log'], 'a')
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = log
+    try:
+        try:
+            info['result'] = func(*args, **kwargs)
+        except SystemExit:
+            # abort() already wrote the reason to the log
+            info['status'] = 'failed'
+            info['error'] = 'aborted'
+        except Exception, e:
+            info['status'] = 'failed'
+            info['error'] = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        log.close()
+    info['duration'] = time.time() - start
+    info['timings'] = remote._timings[inherited:]
+    info['ssh'] = pool._since(inherited_ssh)
+    return info
+
+
+def _execute_parallel(func, hosts, args=(), kwargs=None):
+    '''
+    Run ``func`` on all ``hosts``, using a pool of at most ``env.pool_size``
+    worker processes. Every host gets its own log file and its own status.
+
+    :param func: the function to run on every host
+    :param list hosts: the host strings
+    :return: a dict with the host as key and the dict from
+        :func:`_run_isolated` as value
+    :rtype: dict
+    '''
+    log_dir = getattr(env, 'parallel_log_dir', LOG_DIR)
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    pool_size = int(getattr(env, 'pool_size', 0) or POOL_SIZE)
+    worker = parallel(pool_size=pool_size)(_run_isolated)
+    results = execute(worker, func, args, kwargs or {}, hosts=hosts)
+    for host in hosts:
+        if not isinstance(results.get(host), dict):
+            # the worker itself died, there is only the exception (if any)
+            results[host] = {'status': 'failed', 'duration': 0,
+                             'error': str(results.get(host, 'no result')),
+                             'log': _log_file(host), 'result': None,
+                             'timings': [], 'ssh': {}}
+        # the workers timed their operations in their own process
+        remote._timings.extend(results[host]['timings'])
+        pool._merge(results[host]['ssh'])
+    return results
+
+
+def _duration(seconds):
+    '''Format a number of seconds as ``1h02m03s``'''
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%dh%02dm%02ds' % (hours, minutes, seconds)
+    if minutes:
+        return '%dm%02ds' % (minutes, seconds)
+    return '%ds' % seconds
+
+
+def _print_summary(results):
+    '''
+    Print a table with the outcome and duration per host
+
+    :param dict results: the results of :func:`_execute_parallel`
+    '''
+    rows = [('Host', 'Status', 'Duration', 'Log / error')]
+    for host in sorted(results):
+        info = results[host]
+        rows.append((host, info['status'], _duration(info['duration']),
+                     info['error'] or info['log']))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    for row in rows:
+        puts('  '.join([col.ljust(widths[i]) for i, col in enumerate(row[:3])]
+                       + [row[3]]), show_prefix=False)
+
+
+@runs_once
+def run_parallel(task, *args, **kwargs):
+    '''
+    Run a task on all hosts at the same time, e.g.::
+
+        fab -H web1,web2,web3 -z 20 run_parallel:setup_webserver,type=python
+
+    At most ``env.pool_size`` (``fab -z``, default :data:`POOL_SIZE`) hosts
+    are handled at once. The output of each host goes to
+    ``<env.parallel_log_dir>/<host>.log`` (default :data:`LOG_DIR`), a failing
+    host doesn't stop the others. A summary of all hosts is printed at the
+    end.
+
+    :param str task: the name of the task, any task from the fabfile
+    :param args: the arguments for the task
+    :param kwargs: the keyword arguments for the task
+    '''
+    func = crawl(task, state.commands)
+    if func is None:
+        abort('Unknown task %r' % task)
+    hosts = env.all_hosts
+    results = _execute_parallel(func, hosts, args, kwargs)
+    _print_summary(results)
+    failed = [h for h in hosts if results[h]['status'] != 'ok']
+    if failed:
+        abort('%d of %d hosts failed: %s' % (len(failed), len(hosts),
+                                             ', '.join(failed)))
+    return results
@@ -0,0 +1,486 @@
+import os
+import posixpath
+import subprocess
+
+from fabric.api import env, settings, hide, puts
+from fabric.network import normalize
+from fabric.operations import (_AttributeString, _shell_wrap, _sudo_prefix,
+                               _prefix_commands, _prefix_env_vars)
+from fabric.state import output
+from fabric.utils import error
+
+from gab import reactor
+
+
+__all__ = ['ssh_pool_status', 'close_ssh_pool']
+
+
+# With ``env.ssh_pool`` set, gab.remote sends the remote operations over the
+# system's ssh instead of Fabric's own connections: one master connection per
+# host (OpenSSH ControlMaster) carries every command as a new channel, and it
+# stays open for ``env.ssh_idle_timeout`` seconds after the last one, so the
+# next task (or the next ``fab`` run) doesn't set up a session again. This
+# needs key (or agent) authentication, and sudo without a password or with
+# ``env.password``/``env.sudo_password``. The password is only sent when sudo
+# asks for it: stderr is read separately, the prompt is answered there, and
+# a marker on stderr tells when sudo let the command run, after which its
+# input is closed.
+#
+# The commands are processes of gab.reactor: run() and sudo() wait for them,
+# spawn() and wait() let commands on one or more hosts run at the same time.
+# With ``env.ssh_pool`` set to ``local`` they run in a local shell instead,
+# to try gab without an ssh server.
+
+#: directory on the control machine with the sockets of the master
+#: connections, override with ``env.ssh_control_dir``
+CONTROL_DIR = '~/.gab/ssh'
+#: seconds a master connection stays open without commands, override with
+#: ``env.ssh_idle_timeout``
+IDLE_TIMEOUT = 600
+#: seconds between the keepalive messages of a master connection, override
+#: with ``env.ssh_keepalive``
+KEEPALIVE = 30
+#: number of times a command is sent again over a new connection when the
+#: connection failed, override with ``env.ssh_retries``
+RETRIES = 1
+
+#: exit code of ssh itself when the connection failed
+_SSH_FAILED = 255
+#: what a sudo command prints on stderr once sudo let it run
+_SUDO_OK = 'gab-sudo-ok'
+
+#: the processes that open a master connection, per host
+_opening = {}
+#: the number of commands, how many of them used an open master connection,
+#: the number of new connections and of reconnects
+_stats = {'commands': 0, 'reused': 0, 'connected': 0, 'reconnects': 0}
+
+
+def _ssh_args(host_string):
+    '''
+    The ssh arguments for a host: its user, port and the options for the
+    shared master connection
+
+    :param str host_string: the host string
+    :rtype: list
+    '''
+    user, host, port = normalize(host_string)
+    control_dir = os.path.expanduser(getattr(env, 'ssh_control_dir',
+                                             CONTROL_DIR))
+    if not os.path.isdir(control_dir):
+        os.makedirs(control_dir, 0700)
+    args = ['-p', str(port), '-l', user,
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s/%%r@%%h:%%p' % control_dir,
+            '-o', 'ControlPersist=%d' % int(getattr(env, 'ssh_idle_timeout',
+                                                    IDLE_TIMEOUT)),
+            '-o', 'ServerAliveInterval=%d' % int(getattr(env, 'ssh_keepalive',
+                                                         KEEPALIVE)),
+            '-o', 'ServerAliveCountMax=3',
+            '-o', 'BatchMode=yes']
+    if env.disable_known_hosts:
+        args += ['-o', 'StrictHostKeyChecking=no',
+                 '-o', 'UserKnownHostsFile=/dev/null']
+    keys = env.key_filename or []
+    for key in [keys] if isinstance(keys, basestring) else keys:
+        args += ['-i', key]
+    if env.gateway:
+        gateway_user, gateway, gateway_port = normalize(env.gateway)
+        args += ['-o', 'ProxyCommand=ssh -p %s -l %s -W %%h:%%p %s' % (
+            gateway_port, gateway_user, gateway)]
+    return args + [host]
+
+
+def _connected(args):
+    '''Whether the master connection for the ssh arguments is open'''
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(['ssh', '-O', 'check'] + args,
+                               stdout=devnull, stderr=devnull) == 0
+
+
+def _open(host, args):
+    '''
+    Open the master connection for the ssh arguments in the background (see
+    :mod:`gab.reactor`). If that fails, the commands report why.
+
+    :return: the :class:`gab.reactor.Process` that opens it
+    '''
+    if host not in _opening or _opening[host].done:
+        _opening[host] = reactor.spawn(['ssh', '-f', '-N', '-o',
+                                        'ControlMaster=yes'] + args,
+                                       capture=False)
+    return _opening[host]
+
+
+def _close(args):
+    'Close the master connection for the ssh arguments'
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['ssh', '-O', 'exit'] + args, stdout=devnull,
+                        stderr=devnull)
+
+
+class _Command(object):
+    '''
+    A command on a host that runs in the background, see :func:`spawn` and
+    :func:`wait`
+    '''
+
+    def __init__(self, command, wrapped, use_sudo, stdin='', stdout=None,
+                 password=None):
+        self.host = env.host_string
+        self.stdout = stdout
+        self.command = command
+        self.wrapped = wrapped
+        self.use_sudo = use_sudo
+        self.stdin = stdin
+        self.password = password
+        self.retries = int(getattr(env, 'ssh_retries', RETRIES))
+        self.process = None
+        self.result = None
+        self._reset()
+
+    def _reset(self):
+        'Forget the output of an earlier attempt'
+        self.received = 0
+        self._output = []
+        self._errors = []
+        self._pending = ''
+
+    @property
+    def output(self):
+        'The output (stdout) of the command, unless it went to ``stdout``'
+        return ''.join(self._output)
+
+    @property
+    def errors(self):
+        'The errors (stderr) of the command, unless they went to ``stdout``'
+        return ''.join(self._errors) + self._pending
+
+    def _spawn(self, argv, after=None):
+        self.process = reactor.spawn(argv, self.stdin, after=after,
+                                     on_data=self._on_data,
+                                     on_error=self._on_error,
+                                     keep_stdin=self.password is not None)
+
+    def _on_data(self, data):
+        self.received += len(data)
+        if self.stdout is not None:
+            self.stdout.write(data)
+        else:
+            self._output.append(data)
+
+    def _on_error(self, data):
+        # answer the sudo prompt (only then gets the command the password)
+        # and leave it and the marker out of the errors
+        self._pending += data
+        prompt = env.sudo_prompt
+        if self.password is not None and self._pending.endswith(prompt):
+            self._pending = self._pending[:-len(prompt)]
+            self.process.send(self.password + '\n')
+            self.process.close_stdin()
+        lines = self._pending.split('\n')
+        self._pending = lines.pop()
+        for line in lines:
+            if line == _SUDO_OK:
+                self.process.close_stdin()
+            elif self.stdout is not None:
+                self.stdout.write(line + '\n')
+            else:
+                self._errors.append(line + '\n')
+
+    def start(self):
+        '''
+        Start the command: over the master connection of the host (opened
+        first if there is none), or in a local shell when ``env.ssh_pool``
+        is ``local`` (e.g. for tests, without an ssh server).
+        '''
+        if getattr(env, 'ssh_pool', None) == 'local':
+            self._spawn(['/bin/sh', '-c', self.wrapped])
+            return
+        args = _ssh_args(self.host)
+        _stats['commands'] += 1
+        after = None
+        if self.host in _opening and not _opening[self.host].done:
+            _stats['reused'] += 1
+            after = _opening[self.host]
+        elif _connected(args):
+            _stats['reused'] += 1
+        else:
+            _stats['connected'] += 1
+            after = _open(self.host, args)
+        self._spawn(['ssh'] + args + [self.wrapped], after)
+
+    def retry(self):
+        '''
+        Whether the connection failed and the command was sent again over a
+        new one (at most ``env.ssh_retries`` times). Exit code 255 is only a
+        failed connection when the command sent no output or the master
+        connection is gone, otherwise it's the command's own.
+        '''
+        if (self.process.return_code != _SSH_FAILED or self.retries <= 0 or
+                getattr(env, 'ssh_pool', None) == 'local'):
+            return False
+        args = _ssh_args(self.host)
+        if self.received and _connected(args):
+            return False
+        # a stale master (e.g. the network went away), start over
+        self.retries -= 1
+        _stats['reconnects'] += 1
+        _close(args)
+        self._reset()
+        self._spawn(['ssh'] + args + [self.wrapped], _open(self.host, args))
+        return True
+
+
+def _wrap(command, use_sudo, user=None, shell=True, marker=False):
+    '''
+    The command as the remote shell gets it, like Fabric wraps it. With
+    ``marker``, the shell prints :data:`_SUDO_OK` on stderr first.
+    '''
+    command = _prefix_env_vars(_prefix_commands(command, 'remote'))
+    if marker:
+        command = 'echo %s >&2; %s' % (_SUDO_OK, command)
+    return _shell_wrap(command, env.get('shell_escape', True), shell,
+                       _sudo_prefix(user) if use_sudo else None)
+
+
+def _raw(command, stdin=''):
+    '''
+    Run a command on the current host as it is (no login shell, so nothing
+    of the profile ends up in the output) and wait for it, without any
+    output or error handling
+
+    :return: the output (stdout), the errors (stderr) and the exit code
+    :rtype: tuple
+    '''
+    handle = _Command(command, command, False, stdin)
+    handle.start()
+    _wait_all([handle])
+    return handle.output, handle.errors, handle.process.return_code
+
+
+def _wait_all(handles):
+    'Run the reactor until the commands are done, after their retries'
+    todo = list(handles)
+    while todo:
+        reactor.wait([handle.process for handle in todo])
+        todo = [handle for handle in todo if handle.retry()]
+
+
+def spawn(command, use_sudo=False, user=None, shell=True, stdout=None,
+          **kwargs):
+    '''
+    Start a command on the current host without waiting for it, it runs at
+    the same time as the other commands on this host and on other hosts
+    (see :mod:`gab.reactor`). :func:`wait` gives the results.
+
+    :param str command: the command
+    :param bool use_sudo: run it as root
+    :param stdout: a file-like object that gets the output (stdout and
+        stderr) as it arrives, instead of keeping it in the result
+    :return: a handle for :func:`wait`
+    '''
+    password = (env.sudo_password or env.password) if use_sudo else None
+    # without a shell there is no place for the marker, the input then stays
+    # open until sudo asks for the password or the command is done
+    wrapped = _wrap(command, use_sudo, user, shell,
+                    marker=bool(password and shell))
+    which = 'sudo' if use_sudo else 'run'
+    if output.debug:
+        print('[%s] %s: %s' % (env.host_string, which, wrapped))
+    elif output.running:
+        print('[%s] %s: %s' % (env.host_string, which, command))
+    handle = _Command(command, wrapped, use_sudo, stdout=stdout,
+                      password=password or None)
+    handle.start()
+    return handle
+
+
+def wait(handles, warn_only=False):
+    '''
+    Wait for commands started with :func:`spawn` and handle their output and
+    errors like :func:`fabric.api.run` does.
+
+    :param list handles: the handles of :func:`spawn`
+    :param bool warn_only: only warn about failed commands
+    :return: the results, in the same order
+    :rtype: list
+    '''
+    _wait_all(handles)
+    results = []
+    for handle in handles:
+        with settings(host_string=handle.host,
+                      warn_only=env.warn_only or warn_only):
+            results.append(_result(handle))
+    return results
+
+
+def _result(handle):
+    'The result of a command that is done, like the one of Fabric'
+    which = 'sudo' if handle.use_sudo else 'run'
+    out = handle.output.replace('\r\n', '\n').rstrip('\n')
+    err = handle.errors.replace('\r\n', '\n').rstrip('\n')
+    if output.stdout and handle.stdout is None:
+        for line in out.splitlines():
+            print('[%s] out: %s' % (handle.host, line))
+    if output.stderr and handle.stdout is None:
+        for line in err.splitlines():
+            print('[%s] err: %s' % (handle.host, line))
+    result = _AttributeString(out)
+    result.command = handle.command
+    result.real_command = handle.wrapped
+    result.return_code = handle.process.return_code
+    result.failed = result.return_code not in env.ok_ret_codes
+    result.succeeded = not result.failed
+    result.stderr = _AttributeString(err)
+    if result.failed:
+        error('%s() received nonzero return code %s while executing %r' % (
+            which, result.return_code, handle.command), stdout=out,
+            stderr=err)
+    return result
+
+
+def _command(command, use_sudo, warn_only=False, quiet=False, **kwargs):
+    '''
+    Run a command like :func:`fabric.api.run` and :func:`fabric.api.sudo`:
+    the same prefixes, shell wrapping, output and error handling. Options
+    for Fabric's channels (e.g. ``pty``) don't apply and are ignored.
+    '''
+    manager = settings(hide('everything'), warn_only=True) if quiet else \
+        settings(warn_only=env.warn_only or warn_only)
+    with manager:
+        return wait([spawn(command, use_sudo, **kwargs)])[0]
+
+
+def run(command, **kwargs):
+    'Run a command on the current host, see :func:`fabric.api.run`'
+    return _command(command, False, **kwargs)
+
+
+def sudo(command, **kwargs):
+    'Run a command as root on the current host, see :func:`fabric.api.sudo`'
+    return _command(command, True, **kwargs)
+
+
+def _remote_path(path):
+    '''
+    A remote path relative to the current directory (:func:`cd`), like
+    Fabric's put and get resolve it (:func:`_raw` doesn't apply the prefixes)
+    '''
+    if env.cwd and not path.startswith(('/', '~')):
+        return posixpath.join(env.cwd, path)
+    return path
+
+
+def put(local_path, remote_path, use_sudo=False, mode=None, **kwargs):
+    '''
+    Upload a file (a path or a file-like object) to the current host, see
+    :func:`fabric.api.put`. The content goes over the master connection as
+    the input of ``cat``.
+    '''
+    if isinstance(local_path, basestring):
+        name = os.path.basename(local_path)
+        with open(os.path.expanduser(local_path), 'rb') as f:
+            content = f.read()
+    else:
+        name = os.path.basename(getattr(local_path, 'name', '')) or 'upload'
+        content = local_path.read()
+    remote_path = _remote_path(remote_path)
+    # like Fabric, a directory gets the file with the same name
+    target = 'p=%s; [ -d "$p" ] && p="$p/%s"; ' % (remote_path, name)
+    if use_sudo:
+        tmp = '/tmp/gab-put-%s-%s' % (os.getpid(), _stats['commands'])
+        cmd = 'cat > %s' % tmp
+    else:
+        cmd = target + 'cat > "$p"'
+        if mode is not None:
+            cmd += ' && chmod %o "$p"' % mode
+    with settings(hide('running', 'stdout')):
+        out, err, status = _raw(cmd, content)
+        if status == 0 and use_sudo:
+            move = target + 'mv %s "$p"' % tmp
+            if mode is not None:
+                move += ' && chmod %o "$p"' % mode
+            status = sudo(move, warn_only=True).return_code
+    if status != 0:
+        error('put() failed for %s (exit code %s)' % (remote_path, status),
+              stdout=out, stderr=err)
+    return [remote_path]
+
+
+def get(remote_path, local_path, **kwargs):
+    '''
+    Download a file from the current host, see :func:`fabric.api.get`
+    '''
+    remote_path = _remote_path(remote_path)
+    out, err, status = _raw('cat %s' % remote_path)
+    if status != 0:
+        error('get() failed for %s (exit code %s)' % (remote_path, status),
+              stderr=err)
+        return []
+    with open(local_path, 'wb') as f:
+        f.write(out)
+    return [local_path]
+
+
+def exists(path, use_sudo=False, verbose=False):
+    'Check whether a path exists on the current host'
+    func = sudo if use_sudo else run
+    with settings(hide('everything'), warn_only=True):
+        return not func('test -e %s' % path).failed
+
+
+def sed(filename, before, after, limit='', use_sudo=False, backup='.bak',
+        flags='', shell=False):
+    '''
+    Replace text in a file on the current host, see
+    :func:`fabric.contrib.files.sed` (without asking for the platform
+    first, the hosts are Linux)
+    '''
+    for char in "/'":
+        before = before.replace(char, r'\%s' % char)
+        after = after.replace(char, r'\%s' % char)
+    for char in '()':
+        after = after.replace(char, r'\%s' % char)
+    if limit:
+        limit = r'/%s/ ' % limit
+    func = sudo if use_sudo else run
+    with settings(hide('running', 'stdout')):
+        return func(r"sed -i%s -r -e '%ss/%s/%s/%sg' %s" % (
+            backup, limit, before, after, flags, filename), shell=shell)
+
+
+def _since(start):
+    '''
+    The statistics of this process since ``start`` (an earlier copy of
+    :data:`_stats`), for the parent of a child process
+    '''
+    return dict((key, _stats[key] - start[key]) for key in _stats)
+
+
+def _merge(stats):
+    'Add the statistics of a child process'
+    for key in stats:
+        _stats[key] += stats[key]
+
+
+def report():
+    '''Print how many commands used an open master connection'''
+    if _stats['commands']:
+        puts('SSH: %d of %d commands over an open connection (%d%%), '
+             '%d new connections, %d reconnects' % (
+                 _stats['reused'], _stats['commands'],
+                 100 * _stats['reused'] / _stats['commands'],
+                 _stats['connected'], _stats['reconnects']),
+             show_prefix=False)
+
+
+def ssh_pool_status():
+    '''Show whether the current host has an open master connection'''
+    state = 'open' if _connected(_ssh_args(env.host_string)) else 'closed'
+    puts('master connection: %s' % state)
+
+
+def close_ssh_pool():
+    '''Close the master connection to the current host'''
+    _close(_ssh_args(env.host_string))
@@ -0,0 +1,251 @@
+import errno
+import fcntl
+import os
+import select
+import subprocess
+import time
+from collections import deque
+
+from fabric.api import env
+
+
+# A small event loop for the commands that gab.pool runs with the system's
+# ssh: every command is a child process and one select() loop reads the
+# output of all of them, so one control process can keep commands running on
+# hundreds of hosts (and several commands on one host) without a thread or a
+# process of its own per host. Python 2 has no asyncio, this is the part of
+# it gab needs.
+
+#: maximum number of processes that run at the same time (each one needs a
+#: few file descriptors), override with ``env.reactor_max_running``
+MAX_RUNNING = 100
+#: bytes read from or written to a process at once
+_CHUNK = 1 << 16
+
+#: seconds between two checks of the processes without captured output
+_POLL_INTERVAL = 0.05
+
+#: processes that wait for a free slot (or for the process they come after),
+#: in order
+_waiting = deque()
+#: running processes without captured output
+_polled = []
+#: running processes, by file descriptor: a ``(process, 'read')`` tuple for
+#: stdout, a ``(process, 'error')`` tuple for stderr and, while there is
+#: input left, a ``(process, 'write')`` tuple for stdin
+_running = {}
+
+
+class Process(object):
+    '''
+    A command that runs in the background, see :func:`spawn`. When it's
+    done, ``output`` has its stdout and ``errors`` its stderr (unless they
+    aren't captured or go to ``on_data`` and ``on_error``) and
+    ``return_code`` its exit code.
+    '''
+
+    def __init__(self, argv, stdin='', capture=True, after=None,
+                 on_data=None, on_error=None, keep_stdin=False):
+        self.argv = argv
+        self.stdin = stdin
+        self.capture = capture
+        self.after = after
+        self.on_data = on_data
+        self.on_error = on_error
+        self.keep_stdin = keep_stdin
+        self.output = ''
+        self.errors = ''
+        self.return_code = None
+        self.start = None
+        self.end = None
+        self._chunks = {'read': [], 'error': []}
+        self._process = None
+
+    @property
+    def done(self):
+        'Whether the command finished'
+        return self.return_code is not None
+
+    @property
+    def duration(self):
+        'The number of seconds the command ran'
+        return (self.end or time.time()) - (self.start or time.time())
+
+    def _begin(self):
+        self.start = time.time()
+        if not self.capture:
+            # nothing to select() on, it's polled
+            with open(os.devnull, 'r+') as devnull:
+                self._process = subprocess.Popen(self.argv, stdin=devnull,
+                                                 stdout=devnull,
+                                                 stderr=devnull,
+                                                 close_fds=True)
+            _polled.append(self)
+            return
+        self._process = subprocess.Popen(self.argv, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         close_fds=True)
+        _running[self._process.stdout.fileno()] = (self, 'read')
+        _running[self._process.stderr.fileno()] = (self, 'error')
+        stdin = self._process.stdin.fileno()
+        flags = fcntl.fcntl(stdin, fcntl.F_GETFL)
+        fcntl.fcntl(stdin, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if self.stdin:
+            _running[stdin] = (self, 'write')
+        elif not self.keep_stdin:
+            self._process.stdin.close()
+
+    def send(self, data):
+        '''
+        Write more input to the command, it has to be started with
+        ``keep_stdin`` (e.g. a password when it asks for one)
+        '''
+        if self._process is None or self._process.stdin.closed:
+            return
+        self.stdin += data
+        _running[self._process.stdin.fileno()] = (self, 'write')
+
+    def close_stdin(self):
+        '''
+        Close the input of a command that was started with ``keep_stdin``
+        once it's all written
+        '''
+        self.keep_stdin = False
+        if (self._process is not None and not self.stdin and
+                not self._process.stdin.closed):
+            self._process.stdin.close()
+
+    def _write(self, fd):
+        try:
+            written = os.write(fd, self.stdin[:_CHUNK])
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            # the command doesn't read its input (anymore)
+            written = len(self.stdin)
+        self.stdin = self.stdin[written:]
+        if not self.stdin:
+            del _running[fd]
+            if not self.keep_stdin:
+                self._process.stdin.close()
+
+    def _read(self, fd):
+        kind = _running[fd][1]
+        data = os.read(fd, _CHUNK)
+        callback = self.on_data if kind == 'read' else self.on_error
+        if data and callback is not None:
+            callback(data)
+            return
+        if data:
+            self._chunks[kind].append(data)
+            return
+        # end of stdout or stderr, the process is done (or about to be) after
+        # both
+        del _running[fd]
+        pipe = self._process.stdout if kind == 'read' else self._process.stderr
+        pipe.close()
+        if any(p is self and k != 'write' for p, k in _running.values()):
+            return
+        for other in [f for f, (p, k) in _running.items() if p is self]:
+            del _running[other]
+        if not self._process.stdin.closed:
+            self._process.stdin.close()
+        self.return_code = self._process.wait()
+        self.end = time.time()
+        self.output = ''.join(self._chunks['read'])
+        self.errors = ''.join(self._chunks['error'])
+        self._chunks = {'read': [], 'error': []}
+
+    def _poll(self):
+        if self._process.poll() is not None:
+            _polled.remove(self)
+            self.return_code = self._process.returncode
+            self.end = time.time()
+
+
+def spawn(argv, stdin='', capture=True, after=None, on_data=None,
+          on_error=None, keep_stdin=False):
+    '''
+    Start a command without waiting for it. It starts right away, or as soon
+    as fewer than ``env.reactor_max_running`` (default :data:`MAX_RUNNING`)
+    commands run (and ``after`` is done).
+
+    :param list argv: the program and its arguments
+    :param str stdin: the input for the command
+    :param bool capture: keep the output, otherwise it's thrown away (for
+        commands that leave a process in the background with the output)
+    :param after: a :class:`Process` that has to finish first
+    :param on_data: function that gets the output as it arrives, instead of
+        keeping it
+    :param on_error: function that gets the errors (stderr) as they arrive,
+        instead of keeping them
+    :param bool keep_stdin: keep the input open for :meth:`Process.send`
+        until :meth:`Process.close_stdin`
+    :rtype: :class:`Process`
+    '''
+    process = Process(argv, stdin, capture, after, on_data, on_error,
+                      keep_stdin)
+    _waiting.append(process)
+    _start_waiting()
+    return process
+
+
+def _start_waiting():
+    'Start the waiting processes there is room for'
+    limit = int(getattr(env, 'reactor_max_running', MAX_RUNNING))
+    for process in list(_waiting):
+        running = len(set(p for p, kind in _running.values())) + len(_polled)
+        if running >= limit:
+            break
+        if process.after is None or process.after.done:
+            _waiting.remove(process)
+            process._begin()
+
+
+def _step(timeout=None):
+    '''
+    Wait until one of the running processes has output, takes input or
+    finished, and handle that
+
+    :param float timeout: the maximum number of seconds to wait
+    '''
+    readers = [fd for fd, (p, kind) in _running.items() if kind != 'write']
+    writers = [fd for fd, (p, kind) in _running.items() if kind == 'write']
+    if _polled:
+        timeout = min(timeout, _POLL_INTERVAL) if timeout else _POLL_INTERVAL
+    try:
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+    except select.error, e:
+        if e.args[0] == errno.EINTR:
+            return
+        raise
+    for fd in writable:
+        if fd in _running:
+            _running[fd][0]._write(fd)
+    for fd in readable:
+        if fd in _running:
+            _running[fd][0]._read(fd)
+    for process in list(_polled):
+        process._poll()
+    _start_waiting()
+
+
+def wait(processes):
+    '''
+    Run the loop until all ``processes`` are done. The other running
+    processes make progress at the same time.
+
+    :param list processes: the :class:`Process` objects
+    :return: the ``processes``
+    :rtype: list
+    '''
+    while not all(process.done for process in processes):
+        if not _running and not _polled:
+            # only waiting processes, e.g. after one that failed to start
+            _start_waiting()
+            if not _running and not _polled:
+                raise RuntimeError('Nothing left to run, but the processes '
+                                   'are not done')
+        _step()
+    return processes
@@ -0,0 +1,782 @@
+import atexit
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import posixpath
+import re
+import sys
+import tarfile
+import time
+from StringIO import StringIO
+from collections import deque
+from contextlib import contextmanager
+
+from fabric import api
+from fabric import api as _fabric_api
+from fabric.api import env, settings, hide, show, abort, warn, puts
+from fabric.contrib import files
+from fabric.contrib import files as _fabric_files
+from fabric.operations import (_AttributeString, _prefix_commands,
+                               _prefix_env_vars)
+from fabric.state import output
+from fabric.utils import error
+
+from gab import pool
+
+
+# The gab tasks use the remote operations (run, sudo, put, get, exists,
+# append, sed) from this module instead of the ones from Fabric. They behave
+# the same, but every call is timed (see timing_report()) and run and sudo
+# can be recorded in a batch(). The operations are looked up on ``api`` and
+# ``files`` on every call, so gab.benchmark can put a stand-in in their
+# place; with ``env.ssh_pool`` set, they go over the persistent connections
+# of gab.pool instead. The read-only probes (exists, checksum) are remembered
+# until a write touches the same path. sync() and sync_files() only upload
+# files whose content isn't on the host yet. stream() runs the commands with
+# a lot of output without keeping it all in memory.
+
+#: the commands recorded by :func:`batch`, per host a list of
+#: ``(command, use_sudo)`` tuples
+_batches = {}
+#: one dict per remote operation, see :func:`_timed`
+_timings = []
+#: number of rows in the :func:`timing_report`, override with
+#: ``env.timing_top``
+TIMING_TOP = 20
+
+#: the results of the probes, per host a dict with ``(probe, path,
+#: use_sudo)`` as key
+_probes = {}
+#: the number of probes answered from :data:`_probes` and the number that
+#: went to the host
+_probe_stats = {'hits': 0, 'misses': 0}
+#: commands that write files they don't name (packages, builds, archives,
+#: copies of directories), they forget all probes of the host
+_BROAD_WRITE = re.compile(r'\b(apt-get|aptitude|dpkg|make|install|tar|unzip|'
+                          r'cp|mv|rsync|git|pip|easy_install|gem)\b')
+#: files of at least this many bytes are sent compressed by :func:`sync`,
+#: override with ``env.sync_compress_size``
+COMPRESS_SIZE = 64 * 1024
+
+#: number of output lines :func:`stream` keeps of a command, override with
+#: ``env.stream_tail``
+STREAM_TAIL = 50
+#: directory on the control machine with the output of :func:`stream` per
+#: host, override with ``env.stream_log_dir`` (empty to keep no logs)
+STREAM_LOG_DIR = '~/.gab/logs'
+#: seconds between two progress lines of :func:`stream`, override with
+#: ``env.stream_progress``
+STREAM_PROGRESS = 10
+#: bytes of output Fabric keeps itself for a :func:`stream` (it needs a bit
+#: to recognize the sudo password prompt)
+_STREAM_CAPTURE = 4096
+
+
+def _caller():
+    '''
+    The gab function that called the remote operation, e.g.
+    ``gab.install.install_tmux``. Private helpers and nested functions are
+    skipped, so the time counts for the function that uses them.
+    '''
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        code = frame.f_code
+        if (module.startswith('gab.') and module != __name__
+                and not code.co_name.startswith(('_', '<'))
+                and not code.co_flags & inspect.CO_NESTED):
+            return '%s.%s' % (module, code.co_name)
+        frame = frame.f_back
+    return '?'
+
+
+def _backend(module):
+    '''
+    The module (or stand-in) with the remote operations: ``module``, or
+    :mod:`gab.pool` instead of Fabric's own when ``env.ssh_pool`` is set.
+    '''
+    if module in (_fabric_api, _fabric_files) and getattr(env, 'ssh_pool',
+                                                         False):
+        return pool
+    return module
+
+
+def _shell(use_sudo):
+    'The function that runs a command as root (``use_sudo``) or not'
+    return _backend(api).sudo if use_sudo else _backend(api).run
+
+
+def _timed(operation, command, func, *args, **kwargs):
+    '''
+    Call a remote operation and remember the host, the calling gab
+    function, the command, how long it took, the number of bytes transferred
+    and the outcome.
+
+    :param str operation: the name of the operation, e.g. ``run`` (or
+        ``batch`` for the script of a :func:`batch`)
+    :param str command: the command (or path) for the report
+    :param func: the Fabric function
+    '''
+    timing = {'host': env.host_string, 'task': _caller(),
+              'operation': operation, 'command': command,
+              'start': time.time(), 'bytes': 0, 'status': 'failed'}
+    _timings.append(timing)
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        timing['duration'] = time.time() - timing['start']
+    if operation in ('run', 'sudo', 'batch', 'checksum'):
+        timing['bytes'] = len(result) + len(args[0])
+        timing['status'] = result.return_code
+    elif operation == 'exists':
+        timing['status'] = bool(result)
+    else:
+        timing['status'] = 0
+    return result
+
+
+def _probe_path(path):
+    'The path relative to the current directory (:func:`cd`), if any'
+    if env.cwd and not path.startswith(('/', '~')):
+        return posixpath.join(env.cwd, path)
+    return path
+
+
+def _probe(probe, path, use_sudo, func):
+    '''
+    The remembered result of a probe on the current host, or the result of
+    ``func`` (which is then remembered).
+
+    :param str probe: the name of the probe, e.g. ``exists``
+    :param str path: the path that is probed
+    :param bool use_sudo: whether the probe runs as root
+    :param func: the function that does the probe
+    '''
+    cache = _probes.setdefault(env.host_string, {})
+    key = (probe, _probe_path(path), bool(use_sudo))
+    if key in cache:
+        _probe_stats['hits'] += 1
+    else:
+        _probe_stats['misses'] += 1
+        cache[key] = func()
+    return cache[key]
+
+
+def _remember(probe, path, use_sudo, value):
+    '''
+    Remember the result of a probe on the current host without asking it,
+    e.g. the checksum of a file gab just wrote.
+    '''
+    key = (probe, _probe_path(path), bool(use_sudo))
+    _probes.setdefault(env.host_string, {})[key] = value
+
+
+def _forget_probes(written):
+    '''
+    Forget the probes of the current host for the paths in ``written`` (a
+    command or the path of a file that was written) and the paths below
+    them. Commands that write files they don't name forget everything, and
+    in a :func:`cd` everything in that directory is forgotten (a command
+    can name its paths relative to it).
+
+    :param str written: the command or path
+    '''
+    cache = _probes.get(env.host_string)
+    if not cache:
+        return
+    if _BROAD_WRITE.search(written):
+        cache.clear()
+        return
+    prefixes = [_probe_path(written).rstrip('/') + '/']
+    if env.cwd:
+        prefixes.append(env.cwd.rstrip('/') + '/')
+    for key in list(cache):
+        if key[1] in written or (key[1] + '/').startswith(tuple(prefixes)):
+            del cache[key]
+
+
+def _quote(value):
+    'Quote a value for the shell'
+    return "'%s'" % value.replace("'", "'\\''")
+
+
+def _record(command, use_sudo):
+    '''
+    Add a command to the batch of the current host, with the current
+    directory and prefixes (:func:`cd`, :func:`prefix`, ...) applied.
+
+    :return: an empty (succeeded) result
+    '''
+    command = _prefix_commands(_prefix_env_vars(command), 'remote')
+    _batches[env.host_string].append((command, use_sudo))
+    _forget_probes(command)
+    _timings.append({'host': env.host_string, 'task': _caller(),
+                     'operation': 'sudo' if use_sudo else 'run',
+                     'command': command, 'start': time.time(),
+                     'duration': 0, 'bytes': 0, 'status': 'batched'})
+    result = _AttributeString('')
+    result.command = command
+    result.return_code = 0
+    result.succeeded = True
+    result.failed = False
+    return result
+
+
+def run(command, **kwargs):
+    '''
+    Run a command on the current host, see :func:`fabric.api.run`. In a
+    :func:`batch` the command is only recorded (extra options are ignored).
+    '''
+    if env.host_string in _batches:
+        return _record(command, False)
+    _forget_probes(command)
+    return _timed('run', command, _backend(api).run, command, **kwargs)
+
+
+def sudo(command, **kwargs):
+    '''
+    Run a command as root on the current host, see :func:`fabric.api.sudo`.
+    In a :func:`batch` the command is only recorded (extra options are
+    ignored).
+    '''
+    if env.host_string in _batches:
+        return _record(command, True)
+    _forget_probes(command)
+    return _timed('sudo', command, _backend(api).sudo, command, **kwargs)
+
+
+def put(local_path, remote_path, **kwargs):
+    'Upload a file to the current host, see :func:`fabric.api.put`'
+    _forget_probes(remote_path)
+    timing_count = len(_timings)
+    result = _timed('put', remote_path, _backend(api).put, local_path,
+                    remote_path, **kwargs)
+    if isinstance(local_path, basestring) and os.path.isfile(local_path):
+        _timings[timing_count]['bytes'] = os.path.getsize(local_path)
+    elif hasattr(local_path, 'getvalue'):
+        _timings[timing_count]['bytes'] = len(local_path.getvalue())
+    return result
+
+
+def get(remote_path, local_path, **kwargs):
+    'Download a file from the current host, see :func:`fabric.api.get`'
+    timing_count = len(_timings)
+    result = _timed('get', remote_path, _backend(api).get, remote_path,
+                    local_path, **kwargs)
+    _timings[timing_count]['bytes'] = sum(os.path.getsize(path)
+                                          for path in result
+                                          if os.path.isfile(path))
+    return result
+
+
+def exists(path, use_sudo=False, **kwargs):
+    '''
+    Check whether a path exists on the current host. The answer is
+    remembered until gab writes to the path.
+    '''
+    return _probe('exists', path, use_sudo,
+                  lambda: _timed('exists', path, _backend(files).exists, path,
+                                 use_sudo=use_sudo, **kwargs))
+
+
+def checksum(path, use_sudo=False):
+    '''
+    The SHA-256 checksum of a file on the current host (empty if the file
+    doesn't exist). The answer is remembered until gab writes to the path.
+    '''
+    def probe():
+        cmd = 'sha256sum %s 2>/dev/null | cut -d" " -f1' % path
+        with settings(hide('running', 'stdout'), warn_only=True):
+            return _timed('checksum', path, _shell(use_sudo), cmd).strip()
+    return _probe('checksum', path, use_sudo, probe)
+
+
+def append(filename, text, use_sudo=False):
+    '''
+    Append text to a file on the current host, unless it has the text
+    already. The check and the append are one command.
+
+    :param str filename: the file
+    :param text: a string, appended as one block unless all its (non-empty)
+        lines are in the file, or a list of strings that are checked and
+        appended one by one
+    :param bool use_sudo: write the file as root
+    :return: whether anything was appended
+    :rtype: bool
+    '''
+    if isinstance(text, basestring):
+        text = [text]
+    commands = []
+    for block in text:
+        checks = ['grep -qxF -- %s %s' % (_quote(line), filename)
+                  for line in block.splitlines() if line.strip()]
+        commands.append('{ %s; } 2>/dev/null || { echo %s >> %s && '
+                        'echo gab-appended; }' % (
+                            ' && '.join(checks) or 'true', _quote(block),
+                            filename))
+    _forget_probes(filename)
+    timing_count = len(_timings)
+    with settings(hide('running', 'stdout')):
+        result = _timed('append', filename, _shell(use_sudo),
+                        '\n'.join(commands))
+    _timings[timing_count]['bytes'] = sum(len(block) for block in text)
+    return 'gab-appended' in result
+
+
+def sed(filename, before, after, **kwargs):
+    '''
+    Replace text in a file on the current host, see
+    :func:`fabric.contrib.files.sed`
+    '''
+    _forget_probes(filename)
+    return _timed('sed', filename, _backend(files).sed, filename, before,
+                  after, **kwargs)
+
+
+class _Stream(object):
+    '''
+    The output of a command of :func:`stream`, a file-like object that
+    Fabric (or :mod:`gab.pool`) writes the output to as it arrives. Only the
+    last lines are kept (``tail``), every line goes to ``on_line`` and to
+    the log file of the host.
+    '''
+
+    def __init__(self, command, on_line=None):
+        self.host = env.host_string
+        self.command = command
+        self.on_line = on_line
+        self.tail = deque(maxlen=int(getattr(env, 'stream_tail',
+                                             STREAM_TAIL)))
+        # progress lines only where the output would have been printed
+        self.verbose = output.stdout
+        self.lines = 0
+        self.bytes = 0
+        self.start = self.shown = time.time()
+        self._prefix = '[%s] out: ' % self.host
+        self._partial = ''
+        self._log = None
+        log_dir = getattr(env, 'stream_log_dir', STREAM_LOG_DIR)
+        if log_dir:
+            from gab.build import _makedirs
+            log_dir = os.path.expanduser(log_dir)
+            _makedirs(log_dir)
+            name = self.host.replace(os.sep, '_').replace(':', '_')
+            self.log_path = os.path.join(log_dir, '%s.log' % name)
+            self._log = open(self.log_path, 'a')
+            self._log.write('$ %s\n' % command)
+
+    def write(self, data):
+        self.bytes += len(data)
+        lines = (self._partial + data.replace('\r', '')).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line)
+        interval = float(getattr(env, 'stream_progress', STREAM_PROGRESS))
+        if self.verbose and interval and \
+                time.time() - self.shown >= interval:
+            self.shown = time.time()
+            self._progress('running')
+
+    def flush(self):
+        if self._log is not None:
+            self._log.flush()
+
+    def close(self):
+        if self._partial:
+            self._line(self._partial)
+            self._partial = ''
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _line(self, line):
+        # Fabric puts the prefix before every line it echoes
+        if line.startswith(self._prefix):
+            line = line[len(self._prefix):]
+        self.lines += 1
+        self.tail.append(line)
+        if self._log is not None:
+            self._log.write(line + '\n')
+        if self.on_line is not None:
+            self.on_line(line)
+
+    def _progress(self, state):
+        last = self.tail[-1].strip() if self.tail else ''
+        puts('%s after %ds, %d lines%s' % (
+            state, time.time() - self.start, self.lines,
+            ': %s' % last[:60] if last else ''))
+
+
+def stream(command, use_sudo=False, on_line=None):
+    '''
+    Run a command with a lot of output (package upgrades, builds) on the
+    current host without keeping all of it in memory or printing it. Every
+    line goes to ``on_line`` and to ``<env.stream_log_dir>/<host>.log``
+    (default :data:`STREAM_LOG_DIR`), only the last ``env.stream_tail``
+    lines (default :data:`STREAM_TAIL`) are kept, for the result and for the
+    error when it fails. Instead of the output, a line with the progress is
+    printed every ``env.stream_progress`` seconds (default
+    :data:`STREAM_PROGRESS`). In a :func:`batch` the command is only
+    recorded, like :func:`run`.
+
+    :param str command: the command
+    :param bool use_sudo: run it as root
+    :param on_line: function that gets every line of the output
+    :return: the result, with the last lines of the output
+    '''
+    if env.host_string in _batches:
+        return _record(command, use_sudo)
+    _forget_probes(command)
+    out = _Stream(command, on_line)
+    timing_count = len(_timings)
+    try:
+        # the output has to be "shown" to reach the stream, it isn't printed
+        with settings(show('stdout'), hide('warnings'), warn_only=True):
+            result = _timed('sudo' if use_sudo else 'run', command,
+                            _shell(use_sudo), command, stdout=out,
+                            stderr=out, capture_buffer_size=_STREAM_CAPTURE)
+    finally:
+        out.close()
+        _timings[timing_count]['bytes'] = out.bytes + len(command)
+    if out.verbose:
+        out._progress('failed' if result.failed else 'done')
+    tail = _AttributeString('\n'.join(out.tail))
+    for name in ('command', 'real_command', 'return_code', 'succeeded',
+                 'failed', 'stderr'):
+        setattr(tail, name, getattr(result, name, None))
+    if result.failed:
+        error('%s() received nonzero return code %s while executing %r' % (
+            'sudo' if use_sudo else 'run', result.return_code, command),
+            stdout='\n'.join(out.tail))
+    return tail
+
+
+class _Finished(object):
+    'A command that already ran, see :func:`spawn`'
+
+    def __init__(self, result):
+        self.result = result
+
+
+def concurrent():
+    '''
+    Whether :func:`spawn` runs commands in the background, it does with the
+    SSH pool (``env.ssh_pool``, see :mod:`gab.pool`)
+    '''
+    return _backend(api) is pool
+
+
+def spawn(command, use_sudo=False):
+    '''
+    Start a command on the current host without waiting for it, so it can
+    run at the same time as other commands on this host or on other hosts.
+    :func:`wait` gives the results. Only the SSH pool (see
+    :func:`concurrent`) runs commands in the background, otherwise (and in
+    a :func:`batch`) the command runs right away. Example::
+
+        handles = [spawn('service %s status' % s, use_sudo=True)
+                   for s in ('nginx', 'mysql')]
+        nginx, mysql = wait(handles)
+
+    :param str command: the command
+    :param bool use_sudo: run it as root
+    :return: a handle for :func:`wait`
+    '''
+    if env.host_string in _batches or not concurrent():
+        return _Finished((sudo if use_sudo else run)(command))
+    _forget_probes(command)
+    timing = {'host': env.host_string, 'task': _caller(),
+              'operation': 'sudo' if use_sudo else 'run', 'command': command,
+              'start': time.time(), 'bytes': 0, 'status': 'failed'}
+    _timings.append(timing)
+    handle = pool.spawn(command, use_sudo)
+    handle.timing = timing
+    return handle
+
+
+def wait(handles):
+    '''
+    Wait for the commands started with :func:`spawn`. Failed commands abort
+    (or warn, with ``env.warn_only``) like :func:`run` does, after all of them
+    are done.
+
+    :param list handles: the handles of :func:`spawn`
+    :return: the results, in the same order
+    :rtype: list
+    '''
+    running = [h for h in handles if not isinstance(h, _Finished)]
+    try:
+        results = dict(zip(running, pool.wait(running)))
+    finally:
+        for handle in running:
+            process = handle.process
+            handle.timing['duration'] = process.duration
+            if process.done:
+                handle.timing['bytes'] = handle.received + len(handle.command)
+                handle.timing['status'] = process.return_code
+    return [h.result if isinstance(h, _Finished) else results[h]
+            for h in handles]
+
+
+def _content(local):
+    '''The content of a local file (a path or a file-like object)'''
+    if isinstance(local, basestring):
+        with open(local, 'rb') as f:
+            return f.read()
+    return local.getvalue() if hasattr(local, 'getvalue') else local.read()
+
+
+def sync(local, remote_path, use_sudo=False, mode=None):
+    '''
+    Make a file on the current host the same as a local file. The SHA-256
+    checksums (see :func:`checksum`) are compared first and nothing is sent
+    when they match. Files of ``env.sync_compress_size`` (default
+    :data:`COMPRESS_SIZE`) bytes or more are sent compressed. The directory
+    is created if needed.
+
+    :param local: the local path or a file-like object (e.g. a
+        :class:`StringIO.StringIO` with the content)
+    :param str remote_path: the file on the host
+    :param bool use_sudo: write the file as root
+    :param int mode: the permissions of the file, e.g. ``0644``
+    :return: whether the file was uploaded
+    :rtype: bool
+    '''
+    content = _content(local)
+    digest = hashlib.sha256(content).hexdigest()
+    found = checksum(remote_path, use_sudo=use_sudo)
+    if found == digest:
+        return False
+    command = sudo if use_sudo else run
+    directory = posixpath.dirname(remote_path)
+    if not found and directory:
+        command('mkdir -p %s' % directory)
+    compress_size = int(getattr(env, 'sync_compress_size', COMPRESS_SIZE))
+    if len(content) >= compress_size:
+        packed = StringIO()
+        with gzip.GzipFile(fileobj=packed, mode='wb') as f:
+            f.write(content)
+        packed.seek(0)
+        tmp = '/tmp/gab-sync-%s.gz' % digest[:16]
+        put(packed, tmp)
+        command('gunzip -c %s > %s; rc=$?; rm -f %s; exit $rc' % (
+            tmp, remote_path, tmp))
+        if mode is not None:
+            command('chmod %o %s' % (mode, remote_path))
+    else:
+        put(StringIO(content), remote_path, use_sudo=use_sudo, mode=mode)
+    _remember('checksum', remote_path, use_sudo, digest)
+    return True
+
+
+def sync_files(pairs, use_sudo=False):
+    '''
+    Like :func:`sync` for a lot of files: the checksums of all files are
+    asked with one command and the changed files are sent as one compressed
+    tarball, so it doesn't matter how many (small) files there are.
+
+    :param list pairs: ``(local path, remote path)`` tuples, remote paths
+        are absolute, in the home directory (``~/...``) or relative to the
+        current directory
+    :param bool use_sudo: write the files as root
+    :return: the remote paths that were uploaded
+    :rtype: list
+    '''
+    cache = _probes.setdefault(env.host_string, {})
+    unknown = [remote_path for local, remote_path in pairs
+               if ('checksum', _probe_path(remote_path), bool(use_sudo))
+               not in cache]
+    if unknown:
+        cmd = '\n'.join('echo gab-sum $(sha256sum %s 2>/dev/null | '
+                        'cut -d" " -f1)' % path for path in unknown)
+        with settings(hide('running', 'stdout'), warn_only=True):
+            output = _timed('checksum', '%d files' % len(unknown),
+                            _shell(use_sudo), cmd)
+        sums = [line.split()[1:] for line in output.splitlines()
+                if line.startswith('gab-sum')]
+        # a file without an answer counts as missing
+        sums += [[]] * (len(unknown) - len(sums))
+        for path, digest in zip(unknown, sums):
+            _probe_stats['misses'] += 1
+            _remember('checksum', path, use_sudo, ''.join(digest))
+    _probe_stats['hits'] += len(pairs) - len(unknown)
+    changed = []
+    for local, remote_path in pairs:
+        with open(local, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if cache[('checksum', _probe_path(remote_path),
+                  bool(use_sudo))] != digest:
+            changed.append((local, remote_path, digest))
+    if not changed:
+        return []
+    # one tarball, with a member directory per root it's unpacked in
+    packed = StringIO()
+    roots = []
+    with tarfile.open(fileobj=packed, mode='w:gz') as tar:
+        for local, remote_path, digest in changed:
+            if remote_path.startswith('/'):
+                root, name = '/', remote_path[1:]
+            elif remote_path.startswith('~/'):
+                root, name = '~', remote_path[2:]
+            else:
+                root, name = '.', remote_path
+            if root not in roots:
+                roots.append(root)
+            tar.add(local, '%d/%s' % (roots.index(root), name))
+    packed.seek(0)
+    tmp = '/tmp/gab-sync-%s.tar.gz' % hashlib.sha256(
+        packed.getvalue()).hexdigest()[:16]
+    put(packed, tmp)
+    extract = ['tar xzf %s -C %s --no-same-owner --strip-components=1 %d' % (
+        tmp, target, i) for i, target in enumerate(roots)]
+    (sudo if use_sudo else run)(' && '.join(extract) +
+                                '; rc=$?; rm -f %s; exit $rc' % tmp)
+    for local, remote_path, digest in changed:
+        _remember('checksum', remote_path, use_sudo, digest)
+    return [remote_path for local, remote_path, digest in changed]
+
+
+@contextmanager
+def batch():
+    '''
+    Record the :func:`run` and :func:`sudo` calls and send them to the host
+    as one script when leaving the block, so they only cost one round trip.
+    The script stops at the first failing command (like ``set -e``) and that
+    command is reported.
+
+    Only use this for commands that don't need the output of a previous
+    command. Other operations (e.g. :func:`exists`, :func:`put`) still run
+    immediately. Nested batches are part of the outer batch. Example::
+
+        with batch():
+            sudo('adduser %s admin' % username)
+            sudo('adduser %s adm' % username)
+    '''
+    host = env.host_string
+    if host in _batches:
+        yield
+        return
+    _batches[host] = []
+    try:
+        yield
+    finally:
+        commands = _batches.pop(host)
+    if commands:
+        _run_script(commands)
+
+
+def _run_script(commands):
+    '''
+    Run recorded commands as one script. If any of them needs root, the
+    script runs with ``sudo`` and the others run as the connecting user.
+
+    :param list commands: the ``(command, use_sudo)`` tuples
+    '''
+    use_sudo = any(as_root for command, as_root in commands)
+    description = 'batch of %d commands' % len(commands)
+    lines = ['trap \'rc=$?; [ $rc -eq 0 ] || '
+             'echo "gab-batch: step $step failed with exit code $rc"\' EXIT',
+             'set -e']
+    for i, (command, as_root) in enumerate(commands):
+        if use_sudo and not as_root:
+            command = 'sudo -u "$SUDO_USER" -H bash -c %s' % _quote(command)
+        lines.append('step=%d; (%s)' % (i, command))
+    script = '\n'.join(lines)
+    # the commands already contain their own directory and prefixes
+    with settings(cwd='', command_prefixes=[], warn_only=True):
+        result = _timed('batch', description, _shell(use_sudo), script)
+    if result.failed:
+        match = re.search(r'gab-batch: step (\d+) failed with exit code (\d+)',
+                          result)
+        if match:
+            message = 'Command failed with exit code %s: %s' % (
+                match.group(2), commands[int(match.group(1))][0])
+        else:
+            message = 'Batch failed with exit code %s' % result.return_code
+        if env.warn_only:
+            warn(message)
+        else:
+            abort(message)
+    return result
+
+
+def timing_report():
+    '''
+    Print how much time the remote operations took, per gab function, the
+    slowest operations and how many probes (:func:`exists`,
+    :func:`checksum`) were answered without asking the host. Set
+    ``env.timing`` to print this at the end of every run, e.g. ``fab --set
+    timing=1 setup_webserver``.
+    '''
+    timings = [t for t in _timings if 'duration' in t]
+    if not timings:
+        return
+    top = int(getattr(env, 'timing_top', TIMING_TOP))
+    tasks = {}
+    for timing in timings:
+        task = tasks.setdefault(timing['task'], {'calls': 0, 'time': 0,
+                                                 'bytes': 0})
+        task['calls'] += 1
+        task['time'] += timing['duration']
+        task['bytes'] += timing['bytes']
+    puts('Time per gab function:', show_prefix=False)
+    for name, task in sorted(tasks.items(), key=lambda t: -t[1]['time'])[:top]:
+        puts('  %9.1fs %5d calls %10d bytes  %s' % (
+            task['time'], task['calls'], task['bytes'], name),
+            show_prefix=False)
+    puts('Slowest operations:', show_prefix=False)
+    for timing in sorted(timings, key=lambda t: -t['duration'])[:top]:
+        puts('  %9.1fs  %s  %s  %s %s (%s)' % (
+            timing['duration'], timing['host'], timing['task'],
+            timing['operation'], timing['command'].splitlines()[0][:60],
+            timing['status']), show_prefix=False)
+    pool.report()
+    probes = _probe_stats['hits'] + _probe_stats['misses']
+    if probes:
+        puts('Probes: %d of %d remembered (%d%%)' % (
+            _probe_stats['hits'], probes, 100 * _probe_stats['hits'] / probes),
+            show_prefix=False)
+
+
+def write_trace(path):
+    '''
+    Write all remote operations as a trace (Trace Event Format, JSON), to
+    look at with ``chrome://tracing`` or https://ui.perfetto.dev. Set
+    ``env.timing_trace`` to write it at the end of every run.
+
+    :param str path: the file to write
+    '''
+    events = []
+    hosts = []
+    for timing in _timings:
+        if 'duration' not in timing:
+            continue
+        if timing['host'] not in hosts:
+            hosts.append(timing['host'])
+            events.append({'name': 'process_name', 'ph': 'M',
+                           'pid': len(hosts),
+                           'args': {'name': timing['host']}})
+        events.append({'name': timing['command'].splitlines()[0][:80],
+                       'cat': timing['task'], 'ph': 'X',
+                       'pid': hosts.index(timing['host']) + 1, 'tid': 1,
+                       'ts': int(timing['start'] * 1e6),
+                       'dur': int(timing['duration'] * 1e6),
+                       'args': {'task': timing['task'],
+                                'operation': timing['operation'],
+                                'bytes': timing['bytes'],
+                                'status': str(timing['status'])}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events}, f)
+
+
+def _report():
+    'Print the timing report and write the trace at exit, if wanted'
+    if getattr(env, 'timing', False):
+        timing_report()
+    if getattr(env, 'timing_trace', None):
+        write_trace(env.timing_trace)
+
+
+atexit.register(_report)
@@ -1,7 +1,5 @@
-from fabric.api import sudo
-from fabric.contrib.files import exists, append, sed
-
-from gab.maintenance import apt_update, install
+from gab.maintenance import apt_update, install, flush_install
+from gab.remote import sudo, exists, append
 from gab.services import start, restart, add_service_information
 
 
@@ -24,24 +22,27 @@ def install_serverdensity(url, key):
         sudo('wget http://www.serverdensity.com/downloads/boxedice-public.key -O - | apt-key add -')
         apt_update()
     install('sd-agent')
+    flush_install()
     config = '''
 [Main]
 sd_url: %(url)s
 agent_key: %(key)s
 ''' % {'url': url,
        'key': key}
-    append('/etc/sd-agent/config.cfg', config, use_sudo=True)
-    start('sd-agent')
+    if append('/etc/sd-agent/config.cfg', config, use_sudo=True):
+        restart('sd-agent')
+    else:
+        start('sd-agent')
 
 
 def _update_config(line):
     '''
-    Update the ServerDensity agent and restart it.
+    Update the ServerDensity agent and restart it, if the config changed.
 
     :param str line: the extra data for sd-agent
     '''
-    append('/etc/sd-agent/config.cfg', line, use_sudo=True)
-    restart('sd-agent')
+    if append('/etc/sd-agent/config.cfg', line, use_sudo=True):
+        restart('sd-agent')
 
 
 def sd_add_apache(status_url='http://127.0.0.1/server-status'):
@@ -82,4 +83,8 @@ rabbitmq_user: %(user)s
 rabbitmq_pass: %(passwd)s''' % locals())
 
 
-add_service_information('sd-agent', 'service')
+# the agent checks the other services, so it's restarted after them
+add_service_information('sd-agent', {
+    'type': 'service',
+    'requires': ['apache2', 'nginx', 'mysql', 'memcached', 'rabbitmq-server'],
+})
@@ -1,13 +1,29 @@
-from fabric.api import sudo, run
+import json
+import re
+from contextlib import contextmanager
+
+from fabric.api import env, hide, puts, runs_once
 from fabric.context_managers import settings
 from fabric.contrib.console import confirm
-from fabric.utils import abort
+from fabric.utils import abort, warn
+
+from gab.parallel import _duration, _execute_parallel
+from gab.remote import sudo, spawn, wait, concurrent
+
+
+__all__ = ['add_service_information', 'start', 'stop', 'restart', 'reload',
+           'status', 'fleet_status']
 
 # current format:
 # - key -> dict:
 #   - type: the service type: upstart or service
 #   - restart: support restart? Or a string with the restart command
 #   - name: alias for the service (example apache -> apache2)
+#   - requires: the services that have to be restarted before this one in a
+#     deferred_restart() block (example sd-agent monitors apache2)
+#   - reload: support a graceful reload? Or a string with the reload command
+#   - configtest: command that checks the configuration before a reload
+#   - process: the name of the main process, if it's not the service name
 # - key -> type (shortcut for dict[type])
 
 service_information = {'__default__': {'type': 'upstart',
@@ -21,13 +37,23 @@ STOP_CMD = {
     'upstart': 'stop %(service)s'
 }
 
+#: the services to restart at the end of a :func:`deferred_restart` block,
+#: per host a list of ``(service, action)`` tuples, the action is ``restart``
+#: or ``reload``
+_restart_queue = {}
+#: how deep we are nested in :func:`deferred_restart`, per host
+_restart_depth = {}
+#: the services stopped in the current :func:`deferred_restart` block, per
+#: host
+_stopped = {}
+
 
 def add_service_information(name, value):
     '''
     Add extra information for special services
 
     :param str name: the name of the service
-    :param value: the service information. Support formatting: ``{'type': str, 'restart: bool, 'name': str}``
+    :param value: the service information. Support formatting: ``{'type': str, 'restart: bool, 'name': str, 'requires': list, 'reload': bool, 'configtest': str, 'process': str}``
     :type value: str or dict
     '''
     if not isinstance(value, dict):
@@ -74,6 +100,11 @@ def _supports_restart(service):
         return info['type'] != 'upstart'
 
 
+def _supports_reload(service):
+    service, info = _service_info(service)
+    return info.get('reload', False)
+
+
 def _service_type(service):
     service, info = _service_info(service)
     if 'type' in info:
@@ -92,10 +123,17 @@ def _start(service):
 
 def start(*services):
     '''
-    Start a service or a list of services
+    Start a service or a list of services. In a :func:`deferred_restart`
+    block, a queued restart of a service that was stopped in the block is no
+    longer needed (a service that was running still needs it).
     '''
+    queue = _restart_queue.get(env.host_string, [])
+    stopped = _stopped.get(env.host_string, set())
     for service in services:
         _start(service)
+        if _name(service) in stopped:
+            stopped.discard(_name(service))
+            queue[:] = [q for q in queue if q[0] != _name(service)]
 
 
 def _stop(service):
@@ -124,6 +162,8 @@ def stop(*services):
     '''
     for service in services:
         _stop(service)
+        if _restart_depth.get(env.host_string):
+            _stopped.setdefault(env.host_string, set()).add(_name(service))
 
 
 def _restart(service):
@@ -143,41 +183,340 @@ def _restart(service):
 
 def restart(*services):
     '''
-    Restart a service or a list of services
+    Restart a service or a list of services. In a :func:`deferred_restart`
+    block, the services are only queued.
+    '''
+    for service in services:
+        if _restart_depth.get(env.host_string):
+            _queue(service, 'restart')
+        else:
+            _restart(service)
+
+
+def _reload(service):
+    '''
+    Reload the configuration of a service, after checking it. Services that
+    can't reload are restarted.
+    '''
+    service, info = _service_info(service)
+    reload = _supports_reload(service)
+    if not reload:
+        return _restart(service)
+    if 'configtest' in info:
+        with settings(warn_only=True):
+            if sudo(info['configtest']).failed:
+                abort('The configuration of %s is invalid, not reloaded' %
+                      service)
+    if isinstance(reload, str):
+        sudo(reload)
+    elif _service_type(service) == 'upstart':
+        sudo('reload %s' % service)
+    else:
+        sudo('service %s reload' % service)
+
+
+def reload(*services):
+    '''
+    Reload the configuration of a service or a list of services, without
+    dropping connections (e.g. ``nginx -s reload``, ``apache2ctl
+    graceful``). The configuration is tested first, if the service has a
+    ``configtest``. Services that can't reload are restarted. Use this
+    instead of :func:`restart` when only the configuration changed. In a
+    :func:`deferred_restart` block, the services are only queued (a queued
+    restart of the same service replaces the reload).
+    '''
+    for service in services:
+        if _restart_depth.get(env.host_string):
+            _queue(service, 'reload')
+        else:
+            _reload(service)
+
+
+def _queue(service, action):
+    '''
+    Queue a restart or reload of a service on the current host, see
+    :func:`deferred_restart`.
+
+    :param str service: the service
+    :param str action: ``restart`` or ``reload``
+    '''
+    queue = _restart_queue.setdefault(env.host_string, [])
+    service = _name(service)
+    for i, (queued, queued_action) in enumerate(queue):
+        if queued == service:
+            if action == 'restart':
+                queue[i] = (service, action)
+            return
+    queue.append((service, action))
+
+
+def _restart_order(services):
+    '''
+    Sort the services so every service comes after the services it requires
+    (the ones that aren't in ``services`` are ignored).
+
+    :param list services: the (real) names of the services
+    :rtype: list
     '''
+    order = []
+
+    def visit(service, path):
+        if service in order:
+            return
+        if service in path:
+            abort('Services require each other: %s' %
+                  ' -> '.join(path + [service]))
+        for required in _service_info(service)[1].get('requires', []):
+            if _name(required) in services:
+                visit(_name(required), path + [service])
+        order.append(service)
+
     for service in services:
-        _restart(service)
+        visit(service, [])
+    return order
+
+
+def flush_restart():
+    '''
+    Restart (or reload) all services queued by :func:`deferred_restart` on
+    the current host, once each and in dependency order. Does nothing if
+    nothing is queued.
+    '''
+    actions = dict(_restart_queue.pop(env.host_string, []))
+    for service in _restart_order(list(actions)):
+        if actions[service] == 'reload':
+            _reload(service)
+        else:
+            _restart(service)
+
+
+@contextmanager
+def deferred_restart():
+    '''
+    Collect all :func:`restart` (and :func:`reload`) calls and restart every
+    service only once, when leaving the block (or earlier, on
+    :func:`flush_restart`). Services
+    that have ``requires`` in their information are restarted after the
+    services they require. Nesting is allowed, only the outer block
+    restarts.
+
+    Example::
+
+        with deferred_restart():
+            sd_add_apache()
+            sd_add_nginx_status()
+    '''
+    host = env.host_string
+    _restart_depth[host] = _restart_depth.get(host, 0) + 1
+    try:
+        yield
+    except:
+        _restart_depth[host] -= 1
+        if not _restart_depth[host]:
+            _stopped.pop(host, None)
+        if not _restart_depth[host] and _restart_queue.get(host):
+            # don't restart with what might be half a configuration
+            warn('Not restarted because of the failure: %s' %
+                 ', '.join(q[0] for q in _restart_queue.pop(host)))
+        raise
+    _restart_depth[host] -= 1
+    if not _restart_depth[host]:
+        _stopped.pop(host, None)
+        flush_restart()
 
 
 def _status(service):
-    'Status of a service. Note that not all services support this.'
+    '''
+    The command for the status of a service (``None`` if it has none). Note
+    that not all services support this.
+    '''
     service = _name(service)
     st = _service_type(service)
     if st == 'service':
-        sudo('service %s status' % service)
+        return 'service %s status' % service
     elif st == 'upstart':
-        sudo('status %s' % service)
+        return 'status %s' % service
 
 
 def status(*services):
     '''
     Status of a service or a list of services. Note that not all services
-    support this.
+    support this. With the SSH pool (``env.ssh_pool``) the services are
+    checked at the same time.
+    '''
+    commands = filter(None, [_status(service) for service in services])
+    wait([spawn(command, use_sudo=True) for command in commands])
+
+
+def _status_script(services):
+    '''
+    A script that prints a ``gab-status <service> <state> <pid> <elapsed>``
+    line for every service (``-`` if there is no pid or elapsed time).
+
+    :param list services: the (real) names of the services
+    :rtype: str
     '''
+    lines = []
     for service in services:
-        _status(service)
+        service, info = _service_info(service)
+        if info.get('type') == 'upstart':
+            check = 'status %s 2>/dev/null | grep -q start/running' % service
+        else:
+            check = 'service %s status >/dev/null 2>&1' % service
+        lines.append(
+            '%(check)s && state=running || state=stopped; '
+            'pid=$(pgrep -o -x %(process)s); '
+            'echo gab-status %(service)s $state ${pid:--} '
+            '$(ps -o etime= -p ${pid:-0} || echo -)' % {
+                'check': check, 'service': service,
+                'process': info.get('process', service)})
+    return '\n'.join(lines)
+
+
+def _seconds(elapsed):
+    '''
+    The number of seconds in an elapsed time of ``ps``, e.g. ``1-02:03:04``
+    '''
+    days, _, elapsed = elapsed.rpartition('-')
+    seconds = 0
+    for part in elapsed.split(':'):
+        seconds = seconds * 60 + int(part)
+    return int(days or 0) * 86400 + seconds
+
+
+def _host_status(services):
+    '''
+    The status of the services on the current host, in one command.
+
+    :param list services: the (real) names of the services
+    :return: a dict with the service as key and a dict with the ``state``
+        (``running`` or ``stopped``), ``pid`` and ``uptime`` (in seconds) as
+        value. The pid and uptime are ``None`` if it isn't running.
+    :rtype: dict
+    '''
+    with settings(hide('running', 'stdout'), warn_only=True):
+        return _parse_status(sudo(_status_script(services)))
+
+
+def _parse_status(output):
+    '''
+    The status of the services in the output of :func:`_status_script`, see
+    :func:`_host_status`
+    '''
+    result = {}
+    for match in re.finditer(r'^gab-status (\S+) (\S+) (\S+) (\S+)', output,
+                             re.M):
+        service, state, pid, elapsed = match.groups()
+        found = state == 'running' and pid != '-'
+        result[service] = {
+            'state': state,
+            'pid': int(pid) if found else None,
+            'uptime': _seconds(elapsed) if found and elapsed != '-' else None,
+        }
+    return result
+
+
+def _fleet_concurrent(services):
+    '''
+    The status of the services on all hosts, with the status command of
+    every host running at the same time in this process (see
+    :func:`gab.remote.spawn`)
+
+    :param list services: the (real) names of the services
+    :return: a dict like the one of :func:`gab.parallel._execute_parallel`
+    :rtype: dict
+    '''
+    handles = []
+    for host in env.all_hosts:
+        with settings(hide('running'), host_string=host):
+            handles.append(spawn(_status_script(services), use_sudo=True))
+    with settings(hide('stdout', 'warnings'), warn_only=True):
+        outputs = wait(handles)
+    results = {}
+    for host, handle, output in zip(env.all_hosts, handles, outputs):
+        info = {'status': 'ok', 'error': '', 'result': None,
+                'duration': handle.process.duration}
+        if 'gab-status' not in output and output.failed:
+            info['status'] = 'failed'
+            info['error'] = output.splitlines()[-1] if output else \
+                'exit code %s' % output.return_code
+        else:
+            info['result'] = _parse_status(output)
+        results[host] = info
+    return results
+
+
+@runs_once
+def fleet_status(*services, **options):
+    '''
+    Status of a list of services on all hosts, e.g.::
+
+        fab -H web1,web2,db1 fleet_status:nginx,mysql,memcached
+        fab -H web1,web2,db1 fleet_status:nginx,mysql,output=status.json
+
+    Every host gets one command for all services and the hosts are checked
+    in parallel (at most ``env.pool_size`` at once, see
+    :func:`gab.parallel.run_parallel`). With the SSH pool (``env.ssh_pool``)
+    the commands of all hosts run at the same time from this process. A
+    table with the state, pid and uptime of every service is printed,
+    ``output`` writes it as JSON.
+
+    :param services: the services
+    :param str output: the file for the JSON version
+    :return: a dict with the host as key and the dict of
+        :func:`_host_status` as value (or ``{'error': ...}`` if the host
+        failed)
+    :rtype: dict
+    '''
+    names = [_name(service) for service in services]
+    if concurrent():
+        results = _fleet_concurrent(names)
+    else:
+        results = _execute_parallel(_host_status, env.all_hosts, (names,))
+    report = {}
+    rows = [('Host', 'Service', 'State', 'PID', 'Uptime')]
+    for host in sorted(results):
+        info = results[host]
+        if info['status'] != 'ok':
+            report[host] = {'error': info['error']}
+            rows.append((host, '', 'unknown', '', info['error']))
+            continue
+        report[host] = info['result']
+        for service in names:
+            status = info['result'].get(service, {'state': 'unknown',
+                                                  'pid': None,
+                                                  'uptime': None})
+            rows.append((host, service, status['state'],
+                         str(status['pid'] or ''),
+                         _duration(status['uptime'])
+                         if status['uptime'] is not None else ''))
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    for row in rows:
+        puts('  '.join([col.ljust(widths[i]) for i, col in enumerate(row[:4])]
+                       + [row[4]]), show_prefix=False)
+    if options.get('output'):
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
 
 
 # initialize the default service
 add_service_information('apache', {'name': 'apache2', })
-add_service_information('apache2', 'service')
+add_service_information('apache2', {'type': 'service',
+                                    'reload': 'apache2ctl graceful',
+                                    'configtest': 'apache2ctl configtest'})
 add_service_information('jetty', {'type': 'service', 'restart': False, })
 add_service_information('memcached', 'service')
 add_service_information(
     'mysql',
     {'type': 'service',
-     'stop_cmd': 'service mysql stop; killall mysqld_safe'}
+     'stop_cmd': 'service mysql stop; killall mysqld_safe',
+     'process': 'mysqld'}
 )
-add_service_information('nginx', 'service')
+# nginx is the reverse proxy for apache2
+add_service_information('nginx', {'type': 'service', 'requires': ['apache2'],
+                                  'reload': 'nginx -s reload',
+                                  'configtest': 'nginx -t'})
 add_service_information('rabbitmq', {'name': 'rabbitmq-server', })
-add_service_information('rabbitmq-server', 'service')
+add_service_information('rabbitmq-server', {'type': 'service',
+                                            'process': 'beam.smp'})
@@ -1,4 +1,8 @@
-from gab.maintenance import update, install
+from functools import partial
+
+from gab.graph import run_steps
+from gab.maintenance import update, install, deferred_install
+from gab.services import deferred_restart
 from gab.install import (install_default_packages, install_vcs,
                          install_systools, install_python, install_vlc,
                          install_mysql, install_memcached, install_tmux,
@@ -7,44 +11,114 @@ from gab.install import (install_default_packages, install_vcs,
                          install_rabbitmq, install_dotfiles,)
 
 
+__all__ = ['setup_base', 'setup_desktop', 'setup_developer_desktop',
+           'setup_webserver', 'setup_database', 'setup_apt_cacher',
+           'setup_rabbitmq', 'setup_deb_repo', 'setup_git_mirror']
+
+
+# Every recipe is a set of steps: the name of the step as key and a tuple
+# with the function, the steps it requires and (for the steps that do more
+# than install packages) the files it creates as value (see
+# gab.graph.run_steps). Steps with arguments have them in their name, so a
+# step only counts as done for the same arguments.
+
+def _base_steps():
+    return {
+        'update': (update, []),
+        'install_default_packages': (install_default_packages, ['update']),
+        'install_vcs': (install_vcs, ['update']),
+        'install_systools': (install_systools, ['update']),
+        'install_dotfiles': (install_dotfiles, ['install_vcs'], ['~/.git']),
+        'install_tmux': (install_tmux, ['update'], ['~/bin/tmux']),
+    }
+
+
+def _desktop_steps(type=''):
+    steps = _base_steps()
+    steps.update({
+        'install_python:%s' % type: (partial(install_python, type),
+                                     ['update'],
+                                     ['/usr/local/bin/virtualenv']),
+        'install_vlc': (install_vlc, ['update']),
+        'install_desktop_packages': (partial(install, 'unrar',
+                                             'nautilus-open-terminal',
+                                             'p7zip-full', 'smbfs'),
+                                     ['update']),
+    })
+    return steps
+
+
+def _run(steps):
+    with deferred_install(), deferred_restart():
+        run_steps(steps)
+
+
 def setup_base():
-    update()
-    install_default_packages()
-    install_vcs()
-    install_systools()
-    install_dotfiles()
-    install_tmux()
+    _run(_base_steps())
 
 
 def setup_desktop(type=''):
-    setup_base()
-    install_python(type)
-    install_vlc()
-    install('unrar', 'nautilus-open-terminal', 'p7zip-full', 'smbfs')
+    _run(_desktop_steps(type))
 
 
 def setup_developer_desktop():
-    setup_desktop(type='dev')
-    install_mysql()
+    steps = _desktop_steps(type='dev')
+    steps['install_mysql'] = (install_mysql, ['update'])
+    _run(steps)
 
 
 def setup_webserver(type='python'):
-    setup_base()
-    install_python(type='dev')
-    install_apache2(type)
-    install_mysql_client()
+    steps = _base_steps()
+    steps.update({
+        'install_python:dev': (partial(install_python, type='dev'),
+                               ['update'], ['/usr/local/bin/virtualenv']),
+        'install_apache2:%s' % type: (
+            partial(install_apache2, type), ['update'],
+            ['/etc/apache2/mods-enabled/expires.load']),
+        'install_mysql_client': (install_mysql_client, ['update']),
+    })
+    _run(steps)
 
 
 def setup_database():
-    setup_base()
-    install_mysql()
+    steps = _base_steps()
+    steps['install_mysql'] = (install_mysql, ['update'])
+    _run(steps)
 
 
 def setup_apt_cacher():
-    setup_base()
-    install_apt_cacher()
+    steps = _base_steps()
+    steps['install_apt_cacher'] = (install_apt_cacher, ['update'])
+    _run(steps)
+
+
+def setup_deb_repo():
+    '''
+    Set up the node for the packages of the source builds (see
+    :func:`gab.build.package_build`), apache2 serves them from /var/www
+    '''
+    steps = _base_steps()
+    steps['install_deb_repo'] = (partial(install, 'dpkg-dev', 'apache2'),
+                                 ['update'])
+    _run(steps)
+
+
+def setup_git_mirror():
+    '''
+    Set up the node for the git mirrors (see :mod:`gab.mirror`), apache2
+    serves them from /var/www
+    '''
+    steps = _base_steps()
+    steps['install_git_mirror'] = (partial(install, 'git-core', 'apache2'),
+                                   ['update'])
+    _run(steps)
 
 
 def setup_rabbitmq(user, password, vhost):
-    update()
-    install_rabbitmq(user, password, vhost)
+    _run({
+        'update': (update, []),
+        'install_rabbitmq': (
+            partial(install_rabbitmq, user, password, vhost), ['update'],
+            ['/usr/lib/rabbitmq/lib/rabbitmq_server-2.6.1/plugins/'
+             'rabbitmq_management-2.6.1.ez']),
+    })